@@ -30,254 +30,878 @@ SOFTWARE.
 """
 
 import aula
+import prefilter
+import dedup
+import metrics
+from store import Store, cache_key
 
 from pathlib import Path
-from gpt4all import GPT4All
 
 import re
 from datetime import datetime, timedelta
 from dateutil import parser
+from contextlib import contextmanager
+import argparse
+import weakref
+import sys
 import time
 import json
 
 # set up LLM
 #model_name = 'mistral-7b-instruct-v0.1.Q4_0.gguf'
 model_name = 'mistral-7b-openorca.Q4_0.gguf'
-model = GPT4All(model_name)
-# If you already have the model downloaded
-#model_path = Path.home() / 'Library' / 'Application Support' / 'nomic.ai' / 'GPT4All'
-#model = GPT4All(model_name, model_path, allow_download=False)
+# size of the context window of the model in tokens
+n_ctx = 2048
+# number of CPU threads of the model, None lets GPT4All decide
+n_threads = None
+# the model is loaded by get_model() the first time it is needed
+model = None
+
+def get_model():
+    global model
+    if model is None:
+        from gpt4all import GPT4All
+        model = GPT4All(model_name, n_ctx=n_ctx, n_threads=n_threads)
+        # If you already have the model downloaded
+        #model_path = Path.home() / 'Library' / 'Application Support' / 'nomic.ai' / 'GPT4All'
+        #model = GPT4All(model_name, model_path, allow_download=False, n_ctx=n_ctx, n_threads=n_threads)
+    return model
 
 system_template = 'A chat between a user and an artificial intelligence assistant. The user is a parent who has children in school and kindergarten. The parent receives messages from the school and kindergarten, but the parent is only interested in messages that are absolutely important: This could be birthday parties for his kids, or meetings with the teachers. The parent particularly dislikes messages that are not important. This could be long discussions between parents, or messages about other kids having lost some of their stuff. The parent only likes very short answers. '
 prompt_template = '### Human: {0}\n### Assistant:' 
-
-# read saved info from file
-try:
-    with open('aila.json', 'r') as file:
-        store = json.load(file)
-except:
-    store = {'message_ids':[],'post_ids':[]}
-#store = {'message_ids':[],'post_ids':[]} # debug
-
-def get_data():
-    # get data from aula
-    aula_posts,aula_messages = aula.run()
-
-    cutoff = lambda current_time: current_time - timedelta(days=4)
-    posts = []
-    msgs = []
-    daily_summary = ""
-    # extract data and generate responses
+summary_prompt = "Here is a message: <begin message>%s</end message> Please make a one sentence summary"
+important_prompt = "Does the message contain important information? Please answer 'yes' or 'no'"
+daily_prompt = "Here all todays messages from the school: %s\n Please make a short summary of the messages."
+# the text sent to the LLM for the new messages of a thread that has been read before
+thread_context = "Summary of the conversation so far: %s\n\nNew messages:\n%s"
+classify_prompt = ("Here is a message: <begin message>%s</end message> Answer in exactly this format:\n"
+                   "Summary: <one sentence summary>\n"
+                   "Important: <yes or no>\n"
+                   "Category: <one word category>\n"
+                   "Deadline: <date of any deadline in the message, or none>")
+
+# 'single' asks for summary, importance, category and deadline in one generation,
+# 'two-pass' asks for the summary and the importance in two generations
+classify_mode = 'single'
+# token limits of the generations
+classify_tokens = 120
+summary_tokens = 100
+daily_tokens = 200
+
+# Message text sent in one prompt is kept below prompt_budget tokens, leaving room
+# in the context window for the system prompt and the answer. Longer texts are
+# summarized in pieces first. Tokens are estimated from the number of characters.
+prompt_budget = 1200
+chars_per_token = 3
+
+# Evaluate the system prompt once per loaded model and rewind the model to the end
+# of it for every message, instead of evaluating it again in every chat session
+prefix_reuse = True
+# n_past of each loaded model right after the system prompt
+prefixes = weakref.WeakKeyDictionary()
+# seconds spent evaluating the system prompts, and while measure_prefix() runs
+# from the start of each generation to its first token (the prompt processing
+# time), otherwise first_token is None
+llm_timings = {'prefix': [], 'first_token': None}
+
+# send only messages the pre-filter cannot rule out as unimportant to the LLM
+use_prefilter = True
+
+# Messages can be run through the LLM by several worker processes, each with its
+# own model using inference_threads CPU threads (see pool.py). With 1 worker the
+# model is run in this process.
+inference_workers = 1
+inference_threads = None
+# the pool of worker processes, started by get_pool() the first time it is needed
+pool = None
+
+# settings passed on to the worker processes
+model_settings = ['model_name', 'n_ctx', 'classify_mode', 'classify_tokens', 'summary_tokens',
+                  'prompt_budget', 'chars_per_token', 'prefix_reuse']
+
+# In batch mode (see batch.py) the LLM runs in a model service shared by all
+# accounts, and service is the client of that service
+service = None
+
+def get_pool():
+    global pool
+    if pool is None:
+        from pool import InferencePool
+        pool = InferencePool(inference_workers, inference_threads, get_store().filename)
+    return pool
+
+# Minutes between checks of the Aula notification feed. Posts and threads are
+# only fetched when a new notification points to them, and in any case once
+# every full run interval. 0 disables the checks.
+poll_minutes = 5
+
+# the store of seen posts and messages is opened by get_store() the first time it is needed
+store = None
+
+def get_store():
+    global store
+    if store is None:
+        # take over the ids of an old aila.json
+        store = Store('aila.db')
+        store.import_json('aila.json')
+    return store
+
+def normalize(text):
+    # collapse whitespace so reformatted copies of a message share cache entries
+    return ' '.join(text.split())
+
+def count_tokens(text):
+    return len(text) // chars_per_token + 1
+
+def split_text(text, budget=None):
+    # split a text in pieces of at most budget tokens, at sentence ends where possible
+    limit = (budget or prompt_budget) * chars_per_token
+    pieces = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?])\s+", normalize(text)):
+        while len(sentence) > limit:
+            pieces += [current] if current else []
+            pieces.append(sentence[:limit])
+            current, sentence = "", sentence[limit:]
+        if current and len(current) + len(sentence) + 1 > limit:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = (current + " " + sentence).strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk(entries, budget=None):
+    # group entries in chunks of at most budget tokens, longer entries are split first
+    budget = budget or prompt_budget
+    chunks = [[]]
+    size = 0
+    for entry in entries:
+        for piece in split_text(entry, budget):
+            if chunks[-1] and size + count_tokens(piece) > budget:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(piece)
+            size += count_tokens(piece)
+    return chunks
+
+def parse_yes_no(answer):
+    # True/False if the answer starts with yes or no (also in Danish), None otherwise
+    match = re.match(r"\W*(yes|no|ja|nej)\b", answer or "", re.IGNORECASE)
+    if match is None:
+        return None
+    return match.group(1).lower() in ('yes', 'ja')
+
+def parse_classification(response):
+    # parse the 'Field: value' lines of a classify_prompt answer. Fields that are
+    # missing are None; a missing summary falls back to the first line of the answer.
+    response = re.sub(r"###.*", "", response, flags=re.DOTALL) # strip prompt if included in response
+    fields = {}
+    for line in response.splitlines():
+        match = re.match(r"\W*(summary|important|category|deadline)\W*:\W*(.*)", line, re.IGNORECASE)
+        if match and match.group(1).lower() not in fields:
+            fields[match.group(1).lower()] = match.group(2).strip()
+    lines = [line.strip() for line in response.splitlines() if line.strip()]
+    none = lambda value: None if not value or value.lower().strip('. ') in ('none', 'no', 'n/a', 'ingen') else value
+    return {'summary': fields.get('summary') or (lines[0] if lines else ""),
+            'important': parse_yes_no(fields.get('important')),
+            'category': none(fields.get('category')),
+            'deadline': none(fields.get('deadline'))}
+
+class SummaryFilter:
+    # passes on only the tokens of the 'Summary:' line of a classify_prompt answer
+    def __init__(self, on_token):
+        self.on_token = on_token
+        self.buffer = ""
+        self.started = False
+        self.done = False
+
+    def __call__(self, token):
+        if self.done:
+            return
+        if not self.started:
+            self.buffer += token
+            match = re.search(r"summary\W*:[ \t]*", self.buffer, re.IGNORECASE)
+            if match is None:
+                return
+            self.started = True
+            token = self.buffer[match.end():]
+        if '\n' in token:
+            token = token.split('\n')[0]
+            self.done = True
+        if token:
+            self.on_token(token)
+
+def context_tokens(model):
+    # number of tokens in the context of a GPT4All model, None if it cannot be read
+    try:
+        return model.model.context.n_past
+    except AttributeError:
+        return None
+
+def generate(model, prompt, max_tokens, on_token=None):
+    # run the model, passing each token to on_token as soon as it is generated.
+    # The number of prompt tokens evaluated (estimated if the model does not
+    # tell), the number of generated tokens, the time to the first token and
+    # the generation speed are recorded in metrics.
+    # GPT4All starts from an empty context outside a chat session and at the
+    # first generation of one, then the system prompt is counted too
+    history = getattr(model, '_history', [])
+    before = 0 if history is None or len(history) == 1 else context_tokens(model)
+    start = time.perf_counter()
+    first = []
+    generated = [0]
+    def callback(token_id, token):
+        if not first:
+            first.append(time.perf_counter() - start)
+        generated[0] += 1
+        return True
+    with metrics.span('llm_generate') as fields:
+        if on_token is None:
+            response = model.generate(prompt, max_tokens=max_tokens, callback=callback)
+        else:
+            response = ""
+            for token in model.generate(prompt, max_tokens=max_tokens, streaming=True, callback=callback):
+                response += token
+                on_token(token)
+        seconds = time.perf_counter() - start
+        after = context_tokens(model)
+        if before is not None and after is not None and after - before >= generated[0]:
+            fields['prompt_tokens'] = after - before - generated[0]
+            metrics.observe('llm_prompt_tokens', fields['prompt_tokens'])
+        else:
+            fields['prompt_tokens_estimated'] = count_tokens(prompt)
+            metrics.observe('llm_prompt_tokens_estimated', fields['prompt_tokens_estimated'])
+        fields['generated_tokens'] = generated[0]
+        metrics.observe('llm_generated_tokens', generated[0])
+        if first:
+            fields['first_token_seconds'] = round(first[0], 6)
+            metrics.observe('llm_first_token_seconds', first[0])
+            if generated[0] > 1 and seconds > first[0]:
+                fields['tokens_per_second'] = round((generated[0] - 1) / (seconds - first[0]), 2)
+                metrics.observe('llm_tokens_per_second', fields['tokens_per_second'])
+    if llm_timings['first_token'] is not None:
+        llm_timings['first_token'] += first
+    return response
+
+def can_reuse_prefix(model):
+    # prefix reuse rewinds the GPT4All chat session by hand, which needs its internals
+    return prefix_reuse and hasattr(model, '_history') and hasattr(model, 'model') and hasattr(model.model, 'prompt_model')
+
+@contextmanager
+def chat_session(model):
+    # chat session of the model starting from the system prompt
+    if not can_reuse_prefix(model):
+        with model.chat_session(system_template, prompt_template):
+            yield model
+        return
+
+    if model not in prefixes:
+        # evaluate the system prompt on its own, the same way GPT4All does at the
+        # start of a chat session, and remember where it ends
+        start = time.perf_counter()
+        model.model.prompt_model(system_template, "%1%2", lambda token_id, response: True,
+                                 n_predict=0, reset_context=True, special=True)
+        prefixes[model] = model.model.context.n_past
+        llm_timings['prefix'].append(time.perf_counter() - start)
+
+    with model.chat_session(system_template, prompt_template):
+        # rewind to the end of the system prompt, the tokens after it are
+        # evaluated again by the next generation
+        model.model.context.n_past = prefixes[model]
+        # with more than the system prompt in the history GPT4All continues from
+        # n_past instead of evaluating the system prompt again
+        model._history.append({'role': 'assistant', 'content': ''})
+        yield model
+
+def measure_prefix(texts):
+    # average time to first token of the classify prompt with and without prefix reuse
+    global prefix_reuse
+    model = get_model()
+    reuse = prefix_reuse
+    result = {}
+    try:
+        for prefix_reuse in (False, True):
+            llm_timings['first_token'] = []
+            for text in texts:
+                with chat_session(model):
+                    generate(model, classify_prompt % condense(text), 1)
+            result['reuse' if prefix_reuse else 'no reuse'] = sum(llm_timings['first_token']) / len(texts)
+    finally:
+        prefix_reuse = reuse
+        llm_timings['first_token'] = None
+    result['system prompt'] = llm_timings['prefix'][-1] if llm_timings['prefix'] else None
+    return result
+
+def ask_llm_piece(text):
+    # one sentence summary of a piece of a long message, cached like ask_llm()
+    store = get_store()
+    key = cache_key(normalize(text), system_template, prompt_template, summary_prompt, model_name)
+    cached = store.cache_get(key)
+    if cached is not None:
+        return cached['summary']
+
+    model = get_model()
+    with chat_session(model):
+        summary = re.sub(r"###.*", "", generate(model, summary_prompt % text, summary_tokens)) # strip prompt if included in response
+    store.cache_put(key, {'summary':summary})
+    return summary
+
+def condense(text):
+    # a message longer than the prompt budget is replaced by the summaries of its
+    # pieces, repeated until it fits
+    while count_tokens(text) > prompt_budget:
+        text = " ".join(ask_llm_piece(piece) for piece in split_text(text))
+    return text
+
+def llm_key(text):
+    # cache key of the result of run_llm()
+    if classify_mode == 'single':
+        prompts = (classify_prompt, important_prompt)
+    else:
+        prompts = (summary_prompt, important_prompt)
+    return cache_key(normalize(text), system_template, prompt_template, *prompts, model_name)
+
+def save_result(text, result):
+    # cache the result of run_llm() and keep the verdict for training the pre-filter
+    store = get_store()
+    store.cache_put(llm_key(text), result)
+    store.add_verdict(normalize(text), result['important'])
+
+def ask_llm(text, on_token=None):
+    # summary, importance, category and deadline of a message. Results are cached
+    # by the message text, the prompts and the model, so a message that is
+    # cross-posted or fetched again never runs the LLM twice. The tokens of the
+    # summary are passed to on_token while it is generated.
+    cached = get_store().cache_get(llm_key(text))
+    metrics.count('llm_cache', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        return cached
+    result = run_llm(text, on_token)
+    save_result(text, result)
+    return result
+
+def run_llm(text, on_token=None):
+    # ask_llm() without the cache
+    if service is not None:
+        return service.call('run_llm', text)
+    prompt_text = condense(text)
+    model = get_model()
+    with chat_session(model):
+        if classify_mode == 'single':
+            result = parse_classification(generate(model, classify_prompt % prompt_text, classify_tokens, on_token and SummaryFilter(on_token)))
+        else:
+            summary = re.sub(r"###.*", "", generate(model, summary_prompt % prompt_text, summary_tokens, on_token)) # strip prompt if included in response
+            result = {'summary': summary, 'important': None, 'category': None, 'deadline': None}
+        # ask for the importance on its own if it was not answered
+        if result['important'] is None:
+            result['important'] = parse_yes_no(generate(model, important_prompt, 5)) or False
+    return result
+
+def skipped_result(text):
+    # result for a message the pre-filter ruled out, a short excerpt marked as not important
+    excerpt = normalize(text)
+    if len(excerpt) > 100:
+        excerpt = excerpt[:100] + "..."
+    return {'summary': excerpt + " (skipped by pre-filter)", 'important': False, 'category': None, 'deadline': None, 'skipped': True}
+
+def classify(text, on_token=None):
+    # result of ask_llm() for the messages the pre-filter lets through
+    if use_prefilter and prefilter.route(text) == 'skip':
+        return skipped_result(text)
+    return ask_llm(text, on_token)
+
+def classify_all(texts):
+    # results of classify() for the texts in order, with the LLM work spread over
+    # the worker processes of the pool. Cached results and pre-filtered texts are
+    # handled here; the rest is sent to the pool up front and the results are
+    # taken in order as they are ready. A text that failed gets its exception in
+    # place of the result, so the texts after it are not lost.
+    store = get_store()
+    results = []
+    todo = []
+    for text in texts:
+        if use_prefilter and prefilter.route(text) == 'skip':
+            results.append(skipped_result(text))
+        else:
+            results.append(store.cache_get(llm_key(text)))
+            if results[-1] is None:
+                todo.append(text)
+    done = get_pool().imap(todo)
+    for text, result in zip(texts, results):
+        if result is None:
+            try:
+                waited, result = next(done)
+                metrics.observe('llm_queue_wait_seconds', waited)
+                save_result(text, result)
+            except Exception as e:
+                result = e
+        yield result
+
+def ask_llm_daily(daily_summary, on_token=None):
+    # summary of a chunk of todays messages, cached like ask_llm() and streamed to on_token
+    store = get_store()
+    key = cache_key(normalize(daily_summary), system_template, prompt_template, daily_prompt, model_name)
+    cached = store.cache_get(key)
+    if cached is not None:
+        return cached['summary']
+
+    summary = run_llm_daily(daily_summary, on_token)
+    store.cache_put(key, {'summary':summary})
+    return summary
+
+def run_llm_daily(daily_summary, on_token=None):
+    # ask_llm_daily() without the cache
+    if service is not None:
+        return service.call('run_llm_daily', daily_summary)
+    model = get_model()
+    with chat_session(model):
+        return generate(model, daily_prompt % daily_summary, daily_tokens, on_token)
+
+def stop_pool():
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
+
+def summarize_daily(entries, on_token=None):
+    # summary of todays messages from their one sentence summaries. Entries are
+    # summarized in chunks that fit the prompt budget and the chunk summaries are
+    # summarized again until everything fits in one prompt, so the prompt size is
+    # bounded however many messages arrived. Only the final summary is streamed.
+    while True:
+        chunks = chunk(entries)
+        texts = ["".join("<begin message>%s</end message>\n" % entry for entry in c) for c in chunks]
+        if len(texts) == 1:
+            return ask_llm_daily(texts[0], on_token)
+        entries = [ask_llm_daily(text) for text in texts]
+
+def strip_html(html):
+    return re.sub('\n',' ',re.sub('<[^<]+?>', '', html) )
+
+def new_items(aula_posts,aula_messages,cutoff):
+    # the posts and messages not seen before and newer than the cutoff
+    store = get_store()
+    items = []
     for post in aula_posts['data']['posts']:
         try:
-            if post['id'] in store['post_ids']:
+            if store.seen('post', post['id']):
                 continue
-            else:
-                store['post_ids'].append(post['id'])
-            title = post['title']
-            text = re.sub('\n',' ',re.sub('<[^<]+?>', '', post['content']['html']) )
-            sender = post['ownerProfile']['fullName']
             date_object = parser.parse(post['timestamp'])
             if date_object < cutoff(datetime.now(date_object.tzinfo)):
                 continue
-
-            with model.chat_session(system_template, prompt_template):
-                summary = model.generate("Here is a message: <begin message>%s</end message> Please make a one sentence summary" % text)
-                important = model.generate("Does the message contain important information? Please answer 'yes' or 'no'")
-
-            summary = re.sub(r"###.*", "", summary) # string prompt if included in response
-            important = 'yes' in important.lower()
-            #print("%s, %s: %s,%s\n" % (title,sender,summary,important))
-            posts.append({'title':title,'sender':sender,'text':text,'response':summary,'important':important})
-
-            if True and date_object > datetime.now(date_object.tzinfo)- timedelta(days=1):
-                daily_summary += "<begin message>%s</end message>\n" % text
-        except:
-            pass
+            items.append({'kind':'post','id':post['id'],'title':post['title'],'sender':post['ownerProfile']['fullName'],
+                          'text':strip_html(post['content']['html']),'date':date_object})
+        except (KeyError, TypeError, ValueError) as e:
+            print("skipping post: %r" % e, file=sys.stderr)
+            metrics.error('post', e, id=post.get('id'))
 
     for thread in aula_messages['data']['threads']:
         try:
             msg = thread['latestMessage']
-            if msg['id'] in store['message_ids']:
+            if store.seen('message', msg['id']):
                 continue
-            else:
-                store['message_ids'].append(msg['id'])
-            title = thread['subject']
-            text = re.sub('\n',' ',re.sub('<[^<]+?>', '', msg['text']['html']) )
-            sender = thread['creator']['fullName']
             date_object = parser.parse(msg['sendDateTime'])
             if date_object < cutoff(datetime.now(date_object.tzinfo)):
                 continue
+            # all replies since the thread was last read, or only the latest message
+            # if the history could not be fetched
+            new = [m for m in thread.get('newMessages', []) if (m.get('text') or {}).get('html')]
+            if new:
+                senders = []
+                for m in new:
+                    name = (m.get('sender') or {}).get('fullName') or thread['creator']['fullName']
+                    if name not in senders:
+                        senders.append(name)
+                sender = ", ".join(senders)
+                text = "\n".join("%s: %s" % ((m.get('sender') or {}).get('fullName') or thread['creator']['fullName'],
+                                              strip_html(m['text']['html'])) for m in new)
+            else:
+                sender = thread['creator']['fullName']
+                text = strip_html(msg['text']['html'])
+            # the LLM reads the new messages together with the summary of the thread so far
+            state = store.thread(thread['id'])
+            summary = state[1] if state else None
+            items.append({'kind':'message','id':msg['id'],'title':thread['subject'],'sender':sender,
+                          'text':text,'date':date_object,'thread':thread['id'],'thread_summary':summary,
+                          'llm_text':thread_context % (summary, text) if summary else text})
+        except (KeyError, TypeError, ValueError) as e:
+            print("skipping message: %r" % e, file=sys.stderr)
+            metrics.error('message', e, thread=thread.get('id'))
+    return items
+
+def check_notifications():
+    # which of 'posts' and 'threads' have notifications not seen before, and the
+    # ids of those notifications, or None if Aula could not be reached
+    notifications = aula.poll()
+    if notifications is None:
+        return None
+    store = get_store()
+    areas = set()
+    ids = []
+    for notification in notifications:
+        id = notification.get('notificationId') or notification.get('id')
+        if id is None or store.seen('notification', id):
+            continue
+        ids.append(id)
+        kind = " ".join(str(notification.get(key) or "") for key in ('notificationArea','notificationEventType','notificationType')).lower()
+        if notification.get('threadId') or 'message' in kind:
+            areas.add('threads')
+        if notification.get('postId') or 'post' in kind:
+            areas.add('posts')
+    return areas, ids
+
+def mark_notifications(ids):
+    store = get_store()
+    for id in ids:
+        store.mark('notification', id)
+
+def poll_data(notify=None, cancel=None, full=False):
+    # get_data() for the areas with new notifications, or for everything if full
+    # is set. None if there was nothing new or Aula could not be reached. The
+    # notifications are marked as seen once they have been handled.
+    found = check_notifications()
+    if found is None and not full:
+        metrics.flush()
+        return None
+    areas, ids = found or (set(), [])
+    result = None
+    if full or areas:
+        result = get_data(notify, cancel, None if full else areas)
+    if not (cancel is not None and cancel.is_set()):
+        mark_notifications(ids)
+    metrics.flush()
+    return result
+
+def get_data(notify=None, cancel=None, areas=None):
+    # fetch new posts and messages from Aula and run them through the LLM.
+    # notify(event, *args) is called with ('progress', done, total), ('start', item)
+    # and ('token', text) while a message is summarized and ('item', item) when it
+    # is done, and with ('summary-start',), ('summary-token', text) and ('summary', text)
+    # for the daily summary. Setting the threading.Event cancel stops the run after
+    # the message being processed. areas limits the fetch to 'posts' or 'threads'.
+    notify = notify or (lambda event, *args: None)
+    cutoff = lambda current_time: current_time - timedelta(days=4)
 
-            with model.chat_session(system_template, prompt_template):
-                summary = model.generate("Here is a message: <begin message>%s</end message> Please make a one sentence summary" % text)
-                important = model.generate("Does the message contain important information? Please answer 'yes' or 'no'")
-            important = 'yes' in important.lower()
-            summary = re.sub(r"###.*", "", summary) # string prompt if included in response
-            #print("%s, %s: %s\n" % (title,sender,summary))
-            msgs.append({'title':title,'sender':sender,'text':text,'response':summary,'important':important})
-
-            if True and date_object > datetime.now(date_object.tzinfo)- timedelta(days=1):
-                daily_summary += "<begin message>%s</end message>\n" % text
-        except:
-            pass
-    
-    # make daily summary
-    if daily_summary:
-        with model.chat_session(system_template, prompt_template):
-            daily_summary = model.generate("Here all todays messages from the school: %s\n Please make a short summary of the messages." % daily_summary)
+    store = get_store()
+
+    # train the pre-filter on the verdicts of earlier runs
+    prefilter.train(store.verdicts())
+    prefilter.stats.update(llm=0, skipped=0)
+
+    # the last message read in a thread, threads whose latest message was
+    # handled before the threads were tracked count as read up to it
+    def last_read(thread):
+        state = store.thread(thread['id'])
+        if state:
+            return state[0]
+        latest = thread['latestMessage']['id']
+        return latest if store.seen('message', latest) else None
+
+    # get data from aula, only the pages newer than the last run
+    sync = store.get('sync', {}) # high-water marks of the posts and threads fetched
+    with metrics.span('stage', stage='fetch'):
+        aula_posts,aula_messages = aula.run(since=sync, cutoff=cutoff(datetime.now().astimezone()), areas=areas, last_read=last_read)
+
+    posts = []
+    msgs = []
+    daily = [] # summaries of the messages of the last day
+    failed = {} # time of the oldest item that failed, by 'posts' and 'threads'
+    # extract data and generate responses
+    with metrics.span('stage', stage='extract'):
+        items = new_items(aula_posts,aula_messages,cutoff)
+    for item in items:
+        metrics.count('items', kind=item['kind'])
+    # copies of the same announcement are read once, with all their senders
+    # shown together, and copies of one read in an earlier run get its result
+    dedup.stats.update(duplicates=0)
+    # a reply to a thread with a summary is read together with that summary, so
+    # its result belongs to the thread alone and it is never grouped
+    grouped = [i for i, item in enumerate(items) if not item.get('thread_summary')]
+    with metrics.span('stage', stage='dedup'):
+        clusters = [([grouped[j] for j in members], vector, earlier)
+                    for members, vector, earlier in dedup.group([items[i]['text'] for i in grouped], store.embeddings())]
+    clusters += [([i], None, None) for i, item in enumerate(items) if item.get('thread_summary')]
+    clusters.sort(key=lambda cluster: cluster[0][0])
+    notify('progress', 0, len(clusters))
+    # with several inference workers all messages are dispatched at once and
+    # arrive in order, without streaming
+    todo = [items[members[0]].get('llm_text', items[members[0]]['text']) for members, vector, earlier in clusters if earlier is None]
+    results = classify_all(todo) if inference_workers > 1 and len(todo) > 1 else None
+    for n,(members,vector,earlier) in enumerate(clusters):
+        if cancel is not None and cancel.is_set():
+            break
+        copies = [items[i] for i in members]
+        senders = []
+        for copy in copies:
+            if copy['sender'] not in senders:
+                senders.append(copy['sender'])
+        item = dict(copies[0], sender=", ".join(senders))
+        try:
+            text = item['text']
+            notify('start', item)
+            metrics.count('items_deduplicated', len(copies) - 1 + (earlier is not None))
+            with metrics.span('stage', stage='inference'):
+                if earlier is not None:
+                    result = earlier
+                elif results is not None:
+                    result = next(results)
+                    if isinstance(result, Exception):
+                        raise result
+                else:
+                    result = classify(item.get('llm_text', text), lambda token: notify('token', token))
+            if result.get('skipped') and earlier is None:
+                metrics.count('items_skipped')
+            if vector is not None and earlier is None:
+                store.add_embedding(text, vector, dedup.details(text), result)
+            #print("%s, %s: %s,%s\n" % (title,sender,summary,important))
+            done = {'kind':item['kind'],'id':item['id'],'time':item['date'].timestamp(),'title':item['title'],'sender':item['sender'],'text':text,'response':result['summary'],
+                    'important':result['important'],'category':result['category'],'deadline':result['deadline']}
+            (posts if item['kind'] == 'post' else msgs).append(done)
+            for copy in copies:
+                store.mark(copy['kind'], copy['id'], copy['date'], copy['text'])
+                store.archive(copy['kind'], copy['id'], copy['date'], copy['title'], copy['sender'], copy['text'], result, vector)
+                if copy['kind'] == 'message':
+                    # the summary of the thread up to this message is the starting point next time
+                    store.set_thread(copy['thread'], copy['id'], copy['date'],
+                                     copy['thread_summary'] if result.get('skipped') else result['summary'])
+            notify('item', done)
+
+            if not result.get('skipped') and item['date'] > datetime.now(item['date'].tzinfo)- timedelta(days=1):
+                daily.append("%s, %s: %s" % (item['title'],item['sender'],result['summary']))
+        except Exception as e:
+            print("%s %s failed: %r" % (item['kind'], item['id'], e), file=sys.stderr)
+            metrics.count('items_failed')
+            metrics.error('item', e, kind=item['kind'], id=item['id'])
+            for copy in copies:
+                name = 'posts' if copy['kind'] == 'post' else 'threads'
+                failed[name] = min(failed.get(name, copy['date']), copy['date'])
+        notify('progress', n + 1, len(clusters))
+
+    cancelled = cancel is not None and cancel.is_set()
+    if cancelled and results is not None:
+        # stop the workers from finishing the messages that are no longer wanted
+        stop_pool()
 
-    # save store to file
-    with open('aila.json', 'w') as file:
-        json.dump(store, file)
+    # make daily summary
+    daily_summary = ""
+    if daily and not cancelled:
+        notify('summary-start')
+        with metrics.span('stage', stage='summary'):
+            daily_summary = summarize_daily(daily, lambda token: notify('summary-token', token))
+        notify('summary', daily_summary)
+
+    # move the high-water marks to the newest item seen, unless paging stopped
+    # early or the run was cancelled before all items were processed. If items
+    # failed, the mark is set to the oldest of them, so they are fetched again.
+    for name,result,timestamp in (('posts',aula_posts,aula.post_timestamp),('threads',aula_messages,aula.thread_timestamp)):
+        items = result['data'][name]
+        mark = parser.parse(sync[name]) if sync.get(name) else None
+        if result.get('complete') and items and not cancelled:
+            newest = max(timestamp(item) for item in items)
+            if mark is None or newest > mark:
+                mark = newest
+        if mark is not None and name in failed:
+            mark = min(mark, failed[name])
+        if mark is not None:
+            sync[name] = mark.isoformat()
+    store.set('sync', sync)
+
+    # forget items that are older than the retention window
+    store.evict()
+    metrics.flush()
 
     return posts,msgs,daily_summary
 
-# output to user
-def update_aila():
-    posts,msgs,daily_summary = get_data()
+def details(item):
+    # category and deadline of an item for display
+    text = ""
+    if item.get('category'):
+        text += " [%s]" % item['category']
+    if item.get('deadline'):
+        text += " (deadline: %s)" % item['deadline']
+    return text
+
+def format_item(item):
+    # display line of a processed post or message
+    return "%s, %s, %s: %s%s\n" % (item['title'],item['sender'],item['title'],item['response'],details(item))
+
+def search(query, limit=20, semantic=False):
+    # archived posts and messages matching the words of the query, best first.
+    # semantic ranks by the similarity of the embeddings instead, if available.
+    store = get_store()
+    if semantic:
+        rowids = dedup.nearest(query, store.archive_vectors(), limit)
+        if rowids is not None:
+            return store.archived(rowids)
+    return store.search(query, limit)
+
+def format_hit(hit):
+    # display line of a search result
+    return "%s %s, %s: %s%s\n" % (datetime.fromtimestamp(hit['time']).strftime("%Y-%m-%d"),hit['title'],hit['sender'],
+                                  hit['response'] or hit['text'],details(hit))
+
+def format_output(posts,msgs,daily_summary):
     #posts, msgs = [],[]
     #posts = [{'title':'title','sender':'sender','text':'text','response':'response','important':True},
     #         {'title':'title','sender':'sender','text':'text','response':'response','important':False}]
     output = []
     important = False
-    if posts:
-        for post in posts:
-            output.append(("%s, %s, %s: %s\n" % (post['title'],post['sender'],post['title'],post['response']),post['important']))
-            important = important or post['important']
-    if msgs:
-        for msg in msgs:
-            output.append(("%s, %s, %s: %s\n" % (msg['title'],msg['sender'],msg['title'],msg['response']),msg['important']))
-            important = important or msg['important']
+    for item in posts + msgs:
+        output.append((format_item(item),item['important']))
+        important = important or item['important']
 
     original = ""
-    if posts:
-        for post in posts:
-            original += "%s, %s: %s\n\n" % (post['title'],post['sender'],post['text'])
-    if msgs:
-        for msg in msgs:
-            original += "%s, %s: %s\n\n" % (msg['title'],msg['sender'],msg['text'])
+    for item in posts + msgs:
+        original += "%s, %s: %s\n\n" % (item['title'],item['sender'],item['text'])
 
     # display on console and return
     return output,important,original,daily_summary
 
-# display gui
-import tkinter as tk
-import tkinter.font as tkFont
-
-# Create a Tkinter window
-root = tk.Tk()
-root.title("aila: AI for Aula")
-output = "aila: AI for Aula\n\n"
-
-# Set window size (width x height)
-root.geometry("600x600")
-
-## Create a label widget to display the text
-#label = tk.Label(root, text=output, wraplength=600, anchor='nw', justify='left')
-#label.pack(expand=True, fill="both")
-
-# Create a Text widget and a Scrollbar
-text_widget = tk.Text(root, wrap=tk.WORD, state=tk.DISABLED)
-scrollbar = tk.Scrollbar(root, command=text_widget.yview)
-
-# Configure the Text widget to work with the Scrollbar
-text_widget.configure(yscrollcommand=scrollbar.set)
-# Define a tag for bold text
-default_font = tkFont.nametofont("TkTextFont")
-bold_font = default_font.copy()
-bold_font.configure(weight="bold")
-text_widget.tag_configure("bold", font=bold_font)
-
-# Layout the widgets in the window
-text_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-def init_text():
-    # initial text
-    text_widget.config(state=tk.NORMAL)
-    text_widget.delete('1.0', tk.END)
-    text_widget.insert(tk.END, "Getting data from Aula and running LLM... (this might take a while)\n")
-    text_widget.config(state=tk.DISABLED)
-
-def update_text():
-    # Enable the widget to update the text
-    text_widget.config(state=tk.NORMAL)
-    text_widget.delete('1.0', tk.END)
-    text_widget.insert(tk.END, "Getting data from Aula and running LLM... (this might take a while)\n")
-    # Disable the widget to prevent user editing
-    text_widget.config(state=tk.DISABLED)
-
-    # get data
-    output,important,original,daily_summary = update_aila()
-    #output = []; important = False; original = ""; daily_summary = ""
-
-    # Enable the widget to update the text
-    text_widget.config(state=tk.NORMAL)
-    text_widget.delete('1.0', tk.END)
-
-    text_widget.insert(tk.END, "Updated at " + time.strftime("%H:%M:%S") + ".\n\n")
-    if important:
-        text_widget.insert(tk.END, "Some messages seems to be important. You might want to check them out. ")
-        if daily_summary:
-            text_widget.insert(tk.END, "Summary:\n" + daily_summary + "\n\n\n")
+# output to user
+def update_aila(notify=None, cancel=None, full=True):
+    # formatted result of poll_data(), None if there was nothing new
+    result = poll_data(notify, cancel, full)
+    return format_output(*result) if result is not None else None
+
+# whether tokens of the current message have been printed by print_event()
+streamed = False
+
+def print_event(event, *args):
+    # plain text output of a run as it happens, summaries are printed token by
+    # token and important messages are marked with a star
+    global streamed
+    if event == 'progress' and args[0] == 0 and args[1] > 0:
+        print("Updating at " + time.strftime("%H:%M:%S") + ".")
+    elif event == 'start':
+        item = args[0]
+        print("%s, %s: " % (item['title'],item['sender']), end="")
+        streamed = False
+    elif event == 'token' or event == 'summary-token':
+        print(args[0], end="")
+        streamed = True
+    elif event == 'item':
+        item = args[0]
+        print("%s%s%s" % ("" if streamed else item['response'],details(item)," *" if item['important'] else ""))
+    elif event == 'summary-start':
+        print("\nSummary:")
+        streamed = False
+    elif event == 'summary':
+        print("" if streamed else args[0])
+    sys.stdout.flush()
+
+def print_result(posts,msgs,daily_summary):
+    # plain text output of a finished run, the same as print_event() gives while it runs
+    for item in posts + msgs:
+        print("%s, %s: %s%s%s" % (item['title'],item['sender'],item['response'],details(item)," *" if item['important'] else ""))
+    if daily_summary:
+        print("\nSummary:\n" + daily_summary)
+    if not (posts or msgs):
+        print("No new messages.")
+
+def print_json(posts,msgs,daily_summary,account=None):
+    # one JSON document per run on a single line
+    document = {'time': datetime.now().astimezone().isoformat(), 'posts': posts, 'messages': msgs, 'daily_summary': daily_summary}
+    if account is not None:
+        document = dict(account=account, **document)
+    print(json.dumps(document, ensure_ascii=False))
+    sys.stdout.flush()
+
+def main(argv=None):
+    global inference_workers, inference_threads, n_threads
+    arg_parser = argparse.ArgumentParser(prog='aila', description='Aila: AI for Aula')
+    mode = arg_parser.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true', help='fetch and summarize once, print the result and exit')
+    mode.add_argument('--daemon', action='store_true', help='fetch and summarize every --interval hours without a window')
+    mode.add_argument('--search', metavar='QUERY', help='search the archive of earlier posts and messages and exit')
+    mode.add_argument('--accounts', metavar='FILE', help='fetch and summarize once for each account in the JSON file and exit')
+    arg_parser.add_argument('--parallel', type=int, default=4, help='with --accounts, number of accounts fetched at the same time (default 4)')
+    arg_parser.add_argument('--interval', type=float, default=24, help='hours between full runs in daemon mode (default 24)')
+    arg_parser.add_argument('--poll', type=float, default=poll_minutes,
+                            help='minutes between checks for new notifications in daemon mode, 0 to disable (default %s)' % poll_minutes)
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON, one line per run')
+    arg_parser.add_argument('--workers', type=int, default=inference_workers, help='number of inference worker processes')
+    arg_parser.add_argument('--threads', type=int, default=inference_threads, help='CPU threads of each inference worker')
+    arg_parser.add_argument('--semantic', action='store_true', help='with --search, rank by meaning instead of words')
+    arg_parser.add_argument('--limit', type=int, default=20, help='maximum number of search results (default 20)')
+    arg_parser.add_argument('--metrics-log', metavar='FILE', help='append timing spans and events to FILE as lines of JSON')
+    arg_parser.add_argument('--metrics-file', metavar='FILE', help='write the metrics in the Prometheus text format to FILE after each run')
+    arg_parser.add_argument('--metrics-port', type=int, help='serve the metrics in the Prometheus text format on http://localhost:PORT/metrics')
+    arg_parser.add_argument('--measure-prefix', action='store_true',
+                            help='measure the prompt processing time with and without reuse of the system prompt and exit')
+    args = arg_parser.parse_args(argv)
+
+    inference_workers, inference_threads = args.workers, args.threads
+    metrics.log_file, metrics.prometheus_file = args.metrics_log, args.metrics_file
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if inference_workers <= 1:
+        n_threads = args.threads
+
+    if args.measure_prefix:
+        # measure on the messages of earlier runs
+        texts = [text for text, important in get_store().verdicts()[:5]] or [summary_prompt]
+        for name, seconds in measure_prefix(texts).items():
+            print("%s: %s" % (name, "-" if seconds is None else "%.2fs" % seconds))
+        return 0
+
+    if args.search is not None:
+        hits = search(args.search, args.limit, args.semantic)
+        if args.json:
+            print(json.dumps(hits, ensure_ascii=False))
         else:
-            text_widget.insert(tk.END, "\n")
-    if not important:
-        text_widget.insert(tk.END, "No important messages found - you likely didn't miss anything.\n")
-    
-    for (text,important) in output:
-        # Insert the message followed by a newline
-        text_widget.insert(tk.END, text + "\n")
-
-        # If the message is important, apply the 'bold' tag
-        if important:
-            # The start index is the 'end' of text before inserting the message
-            start_index = text_widget.index(f"{tk.END}-{len(text) + 2}c")
-            # The end index is just before the newline character
-            end_index = text_widget.index(f"{tk.END}-1c")
-            text_widget.tag_add("bold", start_index, end_index)
-
-    text_widget.insert(tk.END, "\n\n------ Original messages -------\n\n\n" + original)
-
-    #text_widget.see(tk.END)
-    # Disable the widget to prevent user editing
-    text_widget.config(state=tk.DISABLED)
-
-
-def run_task():
-    # Scheduled task to run
-    #print("Task running... " + datetime.now().isoformat())
-    try:
-        update_text()
-    except Exception as e:
-        print(e)
-
-    #with open("last_run_time.json", "w") as file:
-    #    # Save the current time as the last run time
-    #    json.dump({"last_run": datetime.now().isoformat()}, file)
-
-# last time check_run() was exectued
-global last_run_time
-last_run_time = datetime.now() - timedelta(hours=25)
-
-def check_run():
-    global last_run_time
-    #try:
-    #    with open("last_run_time.json", "r") as file:
-    #        last_run_time = datetime.fromisoformat(json.load(file)["last_run"])
-    #except (FileNotFoundError, ValueError, KeyError):
-    #    last_run_time = datetime.now() - timedelta(hours=25)
-
-    if datetime.now() - last_run_time > timedelta(hours=24):
-        run_task()
-        last_run_time = datetime.now()
-
-    # Schedule the next check in 1 minute (60000 milliseconds)
-    root.after(60000, check_run)
-
-# Start the check loop
-root.after(1000, init_text)
-root.after(2000, check_run)
-
-# Start the GUI event loop
-root.mainloop()
+            for hit in hits:
+                print(format_hit(hit), end="")
+        return 0
+
+    if args.accounts is not None:
+        import batch
+        failed = 0
+        for name, result in batch.run(batch.load_accounts(args.accounts), args.parallel, max(1, inference_workers), inference_threads):
+            if isinstance(result, Exception):
+                failed += 1
+                print("%s failed: %r" % (name, result), file=sys.stderr)
+            elif args.json:
+                print_json(*result, account=name)
+            else:
+                print("== %s ==" % name)
+                print_result(*result)
+        return 1 if failed else 0
+
+    if not (args.once or args.daemon):
+        # no mode given, show the window
+        import gui
+        gui.main()
+        return 0
+
+    last_full = None
+    while True:
+        try:
+            # a full run every interval, in between only when notifications point to something new
+            full = args.once or last_full is None or time.time() - last_full >= args.interval * 3600
+            if full:
+                last_full = time.time()
+            if full or args.poll:
+                if args.json:
+                    result = poll_data(full=full)
+                    if result is not None:
+                        print_json(*result)
+                else:
+                    result = poll_data(print_event, full=full)
+                    if full and result is not None and not (result[0] or result[1]):
+                        print("No new messages at " + time.strftime("%H:%M:%S") + ".")
+        except Exception as e:
+            metrics.error('run', e)
+            if args.once:
+                raise
+            print(e, file=sys.stderr)
+        if args.once:
+            return 0
+        time.sleep(args.poll * 60 if args.poll else args.interval * 3600)
+
+if __name__ == '__main__':
+    # run main() of the imported module rather than of __main__, so the
+    # settings it makes are the ones gui.py, pool.py and batch.py see
+    import aila
+    sys.exit(aila.main())
@@ -10,26 +10,80 @@ create your own web or terminal interface(s) for Aula.'''
 import requests                 # Perform http/https requests
 from bs4 import BeautifulSoup   # Parse HTML pages
 import json                     # Needed to print JSON API data
+from dateutil import parser     # Parse API timestamps
+import os                       # Atomic replace of the saved session file
+import sys                      # Diagnostics go to stderr, stdout is the output
+import time                     # Latency of each API call
+from concurrent.futures import ThreadPoolExecutor  # Run API calls concurrently
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
 
-# Load the user information from the JSON file
-with open('userinfo.json', 'r') as file:
-    user = json.load(file)
+# The user information is loaded from this JSON file when a login is needed,
+# unless it is given directly in user (as in batch mode, see batch.py)
+user_file = 'userinfo.json'
+user = None
 
-def run():
-    # Start requests session
+def load_user():
+    if user is not None:
+        return user
+    with open(user_file, 'r') as file:
+        return json.load(file)
+
+# All API requests go to the below url
+# Each request has a number of parameters, of which method is always included
+# Data is returned in JSON
+api_url = 'https://www.aula.dk/api/v18/'
+
+# The Unilogin flow starts at login_url and has succeeded when it lands on portal_url
+login_url = 'https://www.aula.dk/auth/login.php?type=unilogin'
+portal_url = 'https://www.aula.dk:443/portal/'
+
+# Cookies and profile context of the last successful login are kept in this file
+# so the Unilogin form loop only runs when the saved session has expired
+session_file = 'aula_session.json'
+
+# Every request gets a (connect, read) timeout in seconds so a stalled request
+# can never hang the program
+timeout = (5, 30)
+
+# Latency in seconds of the API calls made by the last run(), None if the call failed,
+# and the number of pages fetched from each paginated endpoint
+timings = {}
+pages = {}
+
+# Page size and maximum number of pages fetched from posts and threads in one run
+page_size = 10
+max_pages = 50
+
+def new_session():
+    # All requests share one session with a pool of connections. Failed
+    # connections and temporary server errors are retried with a bounded
+    # exponential backoff (0.5s, 1s, 2s).
     session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET', 'POST'])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def login(session):
+    # Load the user information from the JSON file
+    user = load_user()
 
     # Get login page
-    url = 'https://www.aula.dk/auth/login.php?type=unilogin'
-    response = session.get(url)
-    soup = BeautifulSoup(response.text, "lxml")
-    post_url = soup.form['action']
+    with metrics.span('login_step', step='page'):
+        response = session.get(login_url, timeout=timeout)
+        soup = BeautifulSoup(response.text, "lxml")
+        post_url = soup.form['action']
     params = {
         'selectedIdp': 'uni_idp'
     }
 
     # Get login form
-    response = session.post(post_url, data=params)
+    with metrics.span('login_step', step='idp'):
+        response = session.post(post_url, data=params, timeout=timeout)
 
     # Login is handled by a loop where each page is first parsed by BeautifulSoup.
     # Then the destination of the form is saved as the next url to post to and all
@@ -41,134 +95,358 @@ def run():
     success = False
     while success == False and counter < 10:
         try:
-            # Parse response using BeautifulSoup
-            soup = BeautifulSoup(response.text, "lxml")
-            # Get destination of form element (assumes only one)
-            url = soup.form['action']   
-
-            # If form has a destination, inputs are collected and names and values
-            # for posting to form destination are saved to a dictionary called data
-            if url:
-                # Get all inputs from page
-                inputs = soup.find_all('input')
-                # Check whether page has inputs
-                if inputs:
-                    # Create empty dictionary 
-                    data = {}
-                    # Loop through inputs
-                    for input in inputs:
-                        # Some inputs may have no names or values so a try/except
-                        # construction is used.
-                        try:
-                            # Login takes place in single input steps, which
-                            # is the reason for the if/elif construction
-                            # Save username if input is a username field
-                            if input['name'] == 'username':
-                                data[input['name']] = user['username']
-                            # Save password if input is a password field
-                            elif input['name'] == 'password':
-                                data[input['name']] = user['password']
-                            # The login procedure has an additional field to select a role
-                            # If an employee needs to login, this value needs to be changed
-                            elif input['name'] == 'selected-aktoer':
-                                data[input['name']] = "KONTAKT"
-                                #data[input['name']] = "MEDARBEJDER_EKSTERN"    # Replace above line with this for employees
-                            # For all other inputs, save name and value of input
-                            else:
-                                data[input['name']] = input['value']
-                        # If input has no value, an error is caught but needs no handling
-                        # since inputs without values do not need to be posted to next
-                        # destination.
-                        except:
-                            pass
-                # If there's data in the dictionary, it is submitted to the destination url
-                if data:
-                    response = session.post(url, data=data)
-                # If there's no data, just try to post to the destination without data
-                else:
-                    response = session.post(url)
-                # If the url of the response is the Aula front page, loop is exited
-                if response.url == 'https://www.aula.dk:443/portal/':
-                    success = True
+            with metrics.span('login_step', step='form') as fields:
+                fields['form'] = counter
+                # Parse response using BeautifulSoup
+                soup = BeautifulSoup(response.text, "lxml")
+                # Get destination of form element (assumes only one)
+                url = soup.form['action']   
+
+                # If form has a destination, inputs are collected and names and values
+                # for posting to form destination are saved to a dictionary called data
+                if url:
+                    # Get all inputs from page
+                    inputs = soup.find_all('input')
+                    # Check whether page has inputs
+                    if inputs:
+                        # Create empty dictionary 
+                        data = {}
+                        # Loop through inputs
+                        for input in inputs:
+                            # Some inputs may have no names or values so a try/except
+                            # construction is used.
+                            try:
+                                # Login takes place in single input steps, which
+                                # is the reason for the if/elif construction
+                                # Save username if input is a username field
+                                if input['name'] == 'username':
+                                    data[input['name']] = user['username']
+                                # Save password if input is a password field
+                                elif input['name'] == 'password':
+                                    data[input['name']] = user['password']
+                                # The login procedure has an additional field to select a role
+                                # If an employee needs to login, this value needs to be changed
+                                elif input['name'] == 'selected-aktoer':
+                                    data[input['name']] = "KONTAKT"
+                                    #data[input['name']] = "MEDARBEJDER_EKSTERN"    # Replace above line with this for employees
+                                # For all other inputs, save name and value of input
+                                else:
+                                    data[input['name']] = input['value']
+                            # If input has no value, an error is caught but needs no handling
+                            # since inputs without values do not need to be posted to next
+                            # destination.
+                            except:
+                                pass
+                    # If there's data in the dictionary, it is submitted to the destination url
+                    if data:
+                        response = session.post(url, data=data, timeout=timeout)
+                    # If there's no data, just try to post to the destination without data
+                    else:
+                        response = session.post(url, timeout=timeout)
+                    # If the url of the response is the Aula front page, loop is exited
+                    if response.url == portal_url:
+                        success = True
         # If some error occurs, try to just ignore it
         except Exception as e:
-            print(e)
-            pass
+            print(e, file=sys.stderr)
+            metrics.error('login', e, form=counter)
         # One is added to counter each time the loop runs independent of outcome
         counter += 1
 
-    # Login succeeded without an HTTP error code and API requests can begin 
-    if success == True and response.status_code == 200:
-        print("Login lykkedes")
-
-        # All API requests go to the below url
-        # Each request has a number of parameters, of which method is always included
-        # Data is returned in JSON
-        url = 'https://www.aula.dk/api/v18/'
-
-        ### First API request. This request must be run to generate correct correct cookies for subsequent requests. ###
-        params = {
-            'method': 'profiles.getProfilesByLogin'
-            }
-        # Perform request, convert to json and print on screen
-        response_profile = session.get(url, params=params).json()
-        #print(json.dumps(response_profile, indent=4))
-
-        ### Second API request. This request must be run to generate correct correct cookies for subsequent requests. ###
-        params = {
-            'method': 'profiles.getProfileContext',
-            'portalrole': 'guardian',   # 'guardian' for parents (or other guardians), 'employee' for employees
-        }
-        # Perform request, convert to json and print on screen
-        response_profile_context = session.get(url, params=params).json()
-        #print(json.dumps(response_profile_context, indent=4))
-
-        # Loop to get institutions and children associated with profile and save
-        # them to lists
-        institutions = []
-        institution_profiles = []
-        children = []
-        for institution in response_profile_context['data']['institutions']:
-            institutions.append(institution['institutionCode'])
-            institution_profiles.append(institution['institutionProfileId'])
-            for child in institution['children']:
-                children.append(child['id'])
-
-        children_and_institution_profiles = institution_profiles + children
-
-        ### Third example API request, uses data collected from second request ###
-        params = {
-            'method': 'notifications.getNotificationsForActiveProfile',
-            'activeChildrenIds[]': children,
-            'activeInstitutionCodes[]': institutions
+    # Login succeeded without an HTTP error code
+    success = success == True and response.status_code == 200
+    metrics.count('logins', result='ok' if success else 'failed')
+    return success
+
+def api_ok(response):
+    # The API answers with a JSON document containing a status code of 0 when
+    # the request succeeded. An expired session gives an HTTP error, a redirect
+    # to the login page (HTML) or a non-zero status code.
+    if response.status_code != 200:
+        return False
+    try:
+        status = response.json().get('status', {})
+    except ValueError:
+        return False
+    return status.get('code', 0) == 0
+
+def get_profile_context(session):
+    ### First API request. This request must be run to generate correct correct cookies for subsequent requests. ###
+    params = {
+        'method': 'profiles.getProfilesByLogin'
         }
+    # Perform request, convert to json and print on screen
+    response_profile = session.get(api_url, params=params, timeout=timeout).json()
+    #print(json.dumps(response_profile, indent=4))
+
+    ### Second API request. This request must be run to generate correct correct cookies for subsequent requests. ###
+    params = {
+        'method': 'profiles.getProfileContext',
+        'portalrole': 'guardian',   # 'guardian' for parents (or other guardians), 'employee' for employees
+    }
+    # Perform request, convert to json and print on screen
+    response_profile_context = session.get(api_url, params=params, timeout=timeout).json()
+    #print(json.dumps(response_profile_context, indent=4))
+
+    # Loop to get institutions and children associated with profile and save
+    # them to lists
+    institutions = []
+    institution_profiles = []
+    children = []
+    for institution in response_profile_context['data']['institutions']:
+        institutions.append(institution['institutionCode'])
+        institution_profiles.append(institution['institutionProfileId'])
+        for child in institution['children']:
+            children.append(child['id'])
+
+    return {'institutions': institutions, 'institution_profiles': institution_profiles, 'children': children}
+
+def save_session(session, context, filename=None):
+    # Save cookies and profile context. The file is written next to the target
+    # and moved in place so a crash never leaves a half written session behind.
+    filename = filename or session_file
+    cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+                'expires': c.expires, 'secure': c.secure} for c in session.cookies]
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump({'cookies': cookies, 'context': context}, file)
+    # The cookies give access to Aula, keep them private to the user
+    os.chmod(tmp, 0o600)
+    os.replace(tmp, filename)
+
+def load_session(filename=None):
+    # Restore a session saved by save_session(). Returns (None, None) if there
+    # is no usable saved session.
+    filename = filename or session_file
+    try:
+        with open(filename, 'r') as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return None, None
+    session = new_session()
+    for c in saved.get('cookies', []):
+        session.cookies.set_cookie(requests.cookies.create_cookie(**c))
+    return session, saved.get('context')
 
-        # Perform request, convert to json and print on screen
-        notifications_response = session.get(url, params=params).json()
-        #print(json.dumps(notifications_response, indent=4))
+def validate_session(session):
+    # One cheap API call tells whether the saved cookies are still logged in
+    try:
+        response = session.get(api_url, params={'method': 'profiles.getProfilesByLogin'}, timeout=timeout)
+    except requests.RequestException as e:
+        print(e, file=sys.stderr)
+        metrics.error('validate session', e)
+        return False
+    return api_ok(response)
 
-        ### Fourth example API request, only succeeds when the third has been run before ###
-        params = {
+def connect():
+    # Reuse the saved session if it is still valid, otherwise log in again and
+    # resolve the profile context. Returns (session, context) or (None, None).
+    session, context = load_session()
+    if session is not None and context and validate_session(session):
+        return session, context
+
+    session = new_session()
+    if not login(session):
+        return None, None
+    print("Login lykkedes", file=sys.stderr)
+    context = get_profile_context(session)
+    save_session(session, context)
+    return session, context
+
+def fetch(session, name, params):
+    # Perform one API request and record its latency. A request that still
+    # fails after the retries returns None so the other results can be used.
+    start = time.perf_counter()
+    with metrics.span('aula_request', endpoint=name) as fields:
+        try:
+            response = session.get(api_url, params=params, timeout=timeout)
+            fields['status'] = response.status_code
+            data = response.json() if api_ok(response) else None
+            if data is None:
+                print("%s: HTTP %d" % (name, response.status_code), file=sys.stderr)
+                metrics.error('aula request', "HTTP %d" % response.status_code, endpoint=name)
+        except (requests.RequestException, ValueError) as e:
+            print("%s: %s" % (name, e), file=sys.stderr)
+            metrics.error('aula request', e, endpoint=name)
+            data = None
+    # Latencies of the pages of an endpoint add up, a failed page marks the endpoint failed
+    if data is None:
+        timings[name] = None
+    elif timings.get(name, 0) is not None:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+    return data
+
+def sync(session, name, params, items, timestamp, paginate, stop=None):
+    # Page through a list endpoint, newest first, until a page ends with an item
+    # older than stop (the high-water mark of the last run or the cutoff), the
+    # endpoint runs out of items or max_pages is reached. Returns the items of
+    # all pages as {'data': {items: [...]}, 'complete': bool}, or None if the
+    # first page failed. complete is False if paging stopped before reaching
+    # stop, in which case the caller must not move its high-water mark.
+    result = []
+    complete = False
+    for page in range(max_pages):
+        data = fetch(session, name, dict(params, **paginate(page)))
+        if data is None:
+            if page == 0:
+                return None
+            break
+        pages[name] = page + 1
+        batch = data['data'][items]
+        result += batch
+        if len(batch) < page_size or (stop is not None and timestamp(batch[-1]) < stop):
+            complete = True
+            break
+    return {'data': {items: result}, 'complete': complete}
+
+def post_timestamp(post):
+    return parser.parse(post['timestamp'])
+
+def thread_timestamp(thread):
+    return parser.parse(thread['latestMessage']['sendDateTime'])
+
+def thread_messages(session, thread_id, last_id=None, stop=None):
+    # The messages of a thread newer than the message last_id, or than stop (a
+    # datetime) if the thread has not been read before, oldest first. Returns
+    # None if a page failed, so the caller can fall back to the latest message.
+    params = {'method': 'messaging.getMessagesForThread', 'threadId': thread_id}
+    messages = []
+    for page in range(max_pages):
+        data = fetch(session, 'thread messages', dict(params, page=str(page)))
+        if data is None:
+            return None
+        batch = data['data'].get('messages') or []
+        for message in batch:
+            if last_id is not None and str(message.get('id')) == str(last_id):
+                return messages[::-1]
+            if last_id is None and stop is not None and parser.parse(message['sendDateTime']) < stop:
+                return messages[::-1]
+            messages.append(message)
+        if not batch or not data['data'].get('moreMessagesExist'):
+            break
+    return messages[::-1]
+
+def fetch_all(calls):
+    # Run the API requests concurrently over the pooled session, so a refresh
+    # takes as long as the slowest call instead of the sum of all calls
+    with ThreadPoolExecutor(max_workers=min(len(calls), 8)) as executor:
+        futures = {name: executor.submit(*call) for name, call in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+def latency_report():
+    # Human readable latency of each API call of the last run
+    return ", ".join("%s %s%s" % (name, "failed" if t is None else "%.2fs" % t,
+                                  " (%d pages)" % pages[name] if pages.get(name, 1) > 1 else "")
+                     for name, t in timings.items())
+
+def notifications_params(context):
+    ### Third example API request, uses data collected from second request ###
+    return {
+        'method': 'notifications.getNotificationsForActiveProfile',
+        'activeChildrenIds[]': context['children'],
+        'activeInstitutionCodes[]': context['institutions']
+    }
+
+def poll():
+    # Fetch only the notification feed, the cheap way to find out whether there
+    # is anything new. The saved session is used without validating it first;
+    # if the request fails, the session is validated or renewed and the request
+    # is tried once more. Returns the list of notifications, or None if Aula
+    # could not be reached.
+    timings.clear()
+    pages.clear()
+    session, context = load_session()
+    data = None
+    if session is not None and context:
+        data = fetch(session, 'notifications', notifications_params(context))
+    if data is None:
+        session, context = connect()
+        if session is None:
+            return None
+        data = fetch(session, 'notifications', notifications_params(context))
+        if data is None:
+            return None
+    save_session(session, context)
+    return data.get('data') or []
+
+def run(since=None, cutoff=None, areas=None, last_read=None):
+    # Fetch posts and threads from Aula. since holds the high-water marks of the
+    # last run as {'posts': timestamp, 'threads': timestamp} and cutoff is the
+    # oldest time of interest, paging stops at whichever is newest. areas limits
+    # the fetch to some of 'posts' and 'threads', the other gives an empty result.
+    # If last_read is given, last_read(thread) is the id of the last message
+    # read in a thread (or None) and every thread with newer messages gets them,
+    # oldest first, as thread['newMessages'].
+    since = since or {}
+    areas = areas or ('posts', 'threads')
+    def stop(name):
+        marks = [parser.parse(since[name])] if since.get(name) else []
+        marks += [cutoff] if cutoff is not None else []
+        return max(marks) if marks else None
+
+    # Start requests session, reusing the last login when possible
+    session, context = connect()
+
+    # Login succeeded and API requests can begin
+    if session is not None:
+        url = api_url
+        children = context['children']
+        children_and_institution_profiles = context['institution_profiles'] + children
+
+        ### Fourth example API request. Threads are paged through newest first. ###
+        threads_params = {
             'method': 'messaging.getThreads',
             'sortOn': 'date',
             'orderDirection': 'desc',
-            'page': '0'
         }
-
-        # Perform request, convert to json and print on screen
-        messages = session.get(url, params=params).json()
+        threads_call = (sync, session, 'threads', threads_params, 'threads', thread_timestamp,
+                        lambda page: {'page': str(page)}, stop('threads'))
 
         ### Fifth example. getAllPosts uses a combination of children and instituion profiles. ###
-        params = {
+        posts_params = {
             'method': 'posts.getAllPosts',
             'parent': 'profile',
-            'index': "0",
             'institutionProfileIds[]': children_and_institution_profiles,
-            'limit': '10'
+            'limit': str(page_size)
         }
+        posts_call = (sync, session, 'posts', posts_params, 'posts', post_timestamp,
+                      lambda page: {'index': str(page)}, stop('posts'))
+
+        # Perform the requests concurrently and convert to json
+        timings.clear()
+        pages.clear()
+        calls = {'notifications': (fetch, session, 'notifications', notifications_params(context))}
+        if 'threads' in areas:
+            calls['threads'] = threads_call
+        if 'posts' in areas:
+            calls['posts'] = posts_call
+        results = fetch_all(calls)
+        # getThreads has been seen to only succeed when the notifications request
+        # has been run before, so retry it once the notifications are in
+        if 'threads' in results and results['threads'] is None and results['notifications'] is not None:
+            timings.pop('threads', None)
+            results['threads'] = threads_call[0](*threads_call[1:])
+        #print(json.dumps(results['notifications'], indent=4))
 
-        # Perform request, convert to json and print on screen
-        posts = session.get(url, params=params).json()
+        # Fetch the messages of the threads that have new messages since they were last read
+        if last_read is not None and results.get('threads'):
+            calls = {}
+            for thread in results['threads']['data']['threads']:
+                try:
+                    last_id = last_read(thread)
+                    if str(last_id) != str(thread['latestMessage']['id']) and (cutoff is None or thread_timestamp(thread) >= cutoff):
+                        calls[thread['id']] = (thread_messages, session, thread['id'], last_id, cutoff)
+                except (KeyError, TypeError, ValueError) as e:
+                    metrics.error('thread history', e, thread=thread.get('id'))
+            if calls:
+                new_messages = fetch_all(calls)
+                for thread in results['threads']['data']['threads']:
+                    if new_messages.get(thread['id']):
+                        thread['newMessages'] = new_messages[thread['id']]
+
+        # A failed request degrades to an empty result instead of failing the run
+        messages = results.get('threads') or {'data': {'threads': []}, 'complete': False}
+        posts = results.get('posts') or {'data': {'posts': []}, 'complete': False}
 
         #### Sixth example. Posting a calender event. ###
         #params = (
@@ -240,8 +518,11 @@ def run():
         #response_calendar = session.post(url, params=params, json=data).json()
         #print(json.dumps(response_calendar, indent=4))
 
+        # Keep cookies refreshed by the API calls for the next run
+        save_session(session, context)
+
         return posts,messages
 
     # Login failed for some unknown reason
     else:
-        print("Noget gik galt med login")
\ No newline at end of file
+        print("Noget gik galt med login", file=sys.stderr)
\ No newline at end of file
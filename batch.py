@@ -0,0 +1,168 @@
+# batch.py
+#
+# Batch mode for several Aula accounts, e.g. the guardians of several families.
+# Each account has its own credentials, saved session and store, and the
+# accounts are fetched concurrently by a pool of account processes. The account
+# processes do not load a model: all inference, and the embeddings used to find
+# duplicates, go through one model service, a pool of inference workers (see
+# pool.py) that serves the requests of the accounts in turn. Memory grows with
+# the number of models, not with the number of accounts.
+#
+# The accounts are read from a JSON file with a list of accounts:
+#
+#   [{"name": "anna", "username": "...", "password": "..."},
+#    {"name": "bo", "user_file": "userinfo.bo.json"}]
+#
+# and the result of each account is printed with `python -m aila --accounts accounts.json`.
+
+import multiprocessing
+import threading
+import queue
+import json
+import re
+import time
+from collections import deque
+
+import metrics
+
+# store of the model service, it caches the summaries of the pieces of long messages
+service_store = 'aila.service.db'
+
+def load_accounts(filename):
+    with open(filename, 'r') as file:
+        accounts = json.load(file)
+    for account in accounts:
+        if 'name' not in account or not ('user_file' in account or ('username' in account and 'password' in account)):
+            raise ValueError("account needs a name and a user_file or a username and password: %r" % account.get('name'))
+    if len(set(account['name'] for account in accounts)) != len(accounts):
+        raise ValueError("account names must be unique")
+    return accounts
+
+def slug(name):
+    return re.sub(r'\W', '_', name)
+
+class Client:
+    # The model service as seen from an account process. One request is
+    # outstanding at a time, the reply comes on the account's own queue.
+    def __init__(self, account, requests, replies):
+        self.account = account
+        self.requests = requests
+        self.replies = replies
+
+    def call(self, name, text):
+        self.requests.put((self.account, name, text))
+        ok, result = self.replies.get()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+class ModelService:
+    # Runs the LLM requests of all accounts on one pool of inference workers.
+    # Requests are queued per account and the accounts take turns, with at most
+    # one request per worker in flight, so a busy account cannot starve the others.
+    def __init__(self, requests, replies, workers=1, threads=None):
+        from pool import InferencePool
+        self.requests = requests
+        self.replies = replies # reply queue of each account
+        self.workers = workers
+        self.pool = InferencePool(workers, threads, service_store)
+        # requests and freed workers, handled in order by dispatch()
+        self.events = queue.Queue()
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.receiver.start()
+        self.dispatcher.start()
+
+    def receive(self):
+        # move the requests of the account processes to the events
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.events.put(('request', None))
+                return
+            # the arrival time gives the time the request waits for a model
+            self.events.put(('request', request + (time.perf_counter(),)))
+
+    def reply(self, account, ok, result):
+        self.replies[account].put((ok, result))
+        self.events.put(('free', None))
+
+    def dispatch(self):
+        free = self.workers
+        pending = {} # queued requests of each account
+        turn = deque() # accounts with queued requests, in the order of their next turn
+        while True:
+            event, request = self.events.get()
+            if event == 'free':
+                free += 1
+            elif request is None:
+                return
+            else:
+                account, name, text, arrived = request
+                pending.setdefault(account, deque()).append((name, text, arrived))
+                if account not in turn:
+                    turn.append(account)
+            while free and turn:
+                account = turn.popleft()
+                name, text, arrived = pending[account].popleft()
+                if pending[account]:
+                    turn.append(account)
+                free -= 1
+                metrics.observe('llm_queue_wait_seconds', time.perf_counter() - arrived, account=account)
+                metrics.count('llm_requests', account=account, call=name)
+                self.pool.submit(name, text,
+                                 lambda result, account=account: self.reply(account, True, result),
+                                 lambda error, account=account: self.reply(account, False, repr(error)))
+
+    def close(self):
+        self.requests.put(None)
+        self.dispatcher.join()
+        self.pool.close()
+
+def run_account(account, settings, requests, replies, log_file=None):
+    # Runs in an account process: get_data() for the account with its own
+    # session and store, and the LLM requests sent to the model service
+    import aila
+    import aula
+    import dedup
+    from store import Store
+    metrics.log_file = log_file
+    for name, value in settings.items():
+        setattr(aila, name, value)
+    if 'user_file' in account:
+        aula.user_file = account['user_file']
+    else:
+        aula.user = {'username': account['username'], 'password': account['password']}
+    aula.session_file = account.get('session_file') or 'aula_session.%s.json' % slug(account['name'])
+    aila.store = Store(account.get('store') or 'aila.%s.db' % slug(account['name']))
+    aila.service = dedup.service = Client(account['name'], requests, replies)
+    try:
+        return aila.get_data()
+    finally:
+        aila.store.close()
+
+def run(accounts, parallel=4, workers=1, threads=None):
+    # get_data() for each account, with up to parallel accounts fetched at the
+    # same time and workers models shared between them. Yields (account name,
+    # result) in the order of the accounts; result is an exception if the account failed.
+    import aila
+    context = multiprocessing.get_context('spawn')
+    settings = {name: getattr(aila, name) for name in aila.model_settings + ['use_prefilter']}
+    with context.Manager() as manager:
+        requests = manager.Queue()
+        replies = {account['name']: manager.Queue() for account in accounts}
+        service = ModelService(requests, replies, workers, threads)
+        try:
+            # a fresh process for each account, so nothing is shared between accounts
+            with context.Pool(max(1, min(parallel, len(accounts))), maxtasksperchild=1) as account_pool:
+                jobs = [(account['name'], account_pool.apply_async(run_account, (account, settings, requests, replies[account['name']], metrics.log_file)))
+                        for account in accounts]
+                for name, job in jobs:
+                    try:
+                        yield name, job.get()
+                    except Exception as e:
+                        metrics.error('account', e, account=name)
+                        yield name, e
+        finally:
+            service.close()
+            metrics.flush()
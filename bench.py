@@ -0,0 +1,325 @@
+# bench.py
+#
+# Offline benchmark of Aila. Aula is replaced by a local HTTP server that plays
+# the Unilogin flow and serves recorded or synthesized posts and threads, and
+# the LLM and the embedding model are replaced by deterministic fakes with a
+# configurable latency. A run reports the time spent in each stage of
+# get_data() and compares it with a stored baseline, so performance regressions
+# show up.
+#
+# Run `python bench.py` to benchmark against the baseline and
+# `python bench.py --save-baseline` to store the result as the new baseline.
+# The fixtures are synthesized unless a JSON file with recorded payloads is
+# given with --fixtures; --record writes the synthesized fixtures to a file in
+# the same format: {"posts": [...], "threads": [...], "messages": {thread id: [...]}}
+# with the posts and threads as returned by Aula, newest first.
+
+import http.server
+import threading
+import argparse
+import contextlib
+import tempfile
+import hashlib
+import random
+import json
+import time
+import sys
+import io
+import os
+import re
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+
+import aila
+import aula
+import dedup
+from store import Store
+
+baseline_file = 'bench_baseline.json'
+
+# A stage is a regression if it is this much slower than the baseline, and by
+# more than min_difference seconds so timer noise on fast stages is ignored
+tolerance = 0.2
+min_difference = 0.05
+
+stages = ['login', 'fetch', 'html', 'dedup', 'inference', 'summary', 'format']
+
+words = ('husk forældremøde tirsdag klassen udflugt skoven madpakke regntøj fødselsdag invitation '
+         'lørdag kl svømning hallen billeder sommerfest tilmelding frist fredag lus hjemme syg '
+         'madplan uge frokost glemt jakke fundet aflyst idræt omklædning bibliotek bøger').split()
+
+def synthesize(posts=100, threads=50, replies=3, duplicates=0.2, days=5, seed=0):
+    # Fixtures with posts and threads spread over the last days, some posts
+    # copies of earlier ones as when an announcement goes to several children
+    rng = random.Random(seed)
+    now = datetime.now().astimezone()
+    def html():
+        sentences = ["%s." % " ".join(rng.choice(words) for i in range(rng.randint(5, 15))).capitalize()
+                     for j in range(rng.randint(1, 6))]
+        return "<p>" + "</p><p>".join(sentences) + "</p>"
+    def date(i, n):
+        return (now - timedelta(days=days) * (i + 0.5) / n).isoformat()
+
+    fixtures = {'posts': [], 'threads': [], 'messages': {}}
+    for i in range(posts):
+        content = html()
+        if fixtures['posts'] and rng.random() < duplicates:
+            content = rng.choice(fixtures['posts'])['content']['html']
+        fixtures['posts'].append({'id': 1000 + i, 'title': "Opslag %d" % i, 'timestamp': date(i, posts),
+                                  'ownerProfile': {'fullName': "Lærer %d" % rng.randint(1, 10)}, 'content': {'html': content}})
+    for i in range(threads):
+        thread_id = 5000 + i
+        messages = [{'id': thread_id * 100 + j, 'sendDateTime': (now - timedelta(days=days) * (i + 0.5) / threads - timedelta(hours=j)).isoformat(),
+                     'sender': {'fullName': "Forælder %d" % rng.randint(1, 30)}, 'text': {'html': html()}}
+                    for j in range(replies)]
+        fixtures['threads'].append({'id': thread_id, 'subject': "Tråd %d" % i, 'creator': messages[-1]['sender'],
+                                    'latestMessage': messages[0]})
+        fixtures['messages'][str(thread_id)] = messages
+    return fixtures
+
+class AulaStandIn(http.server.BaseHTTPRequestHandler):
+    # Local stand-in of Aula: the Unilogin forms, the portal page and the API
+    # endpoints used by aula.py, answered from self.server.fixtures
+    def base(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def send(self, body, content_type='text/html', status=200, headers=()):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def form(self, action, *inputs):
+        self.send('<html><body><form action="%s%s" method="post">%s</form></body></html>' %
+                  (self.base(), action, "".join('<input name="%s" value="">' % name for name in inputs)))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/auth/login.php':
+            self.form('/login/idp')
+        elif url.path == '/portal/':
+            self.send('<html><body>Aula</body></html>')
+        elif url.path == '/api/':
+            time.sleep(self.server.api_latency)
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            self.send(json.dumps({'status': {'code': 0}, 'data': self.api(query)}), 'application/json')
+        else:
+            self.send('not found', status=404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        if url.path == '/login/idp':
+            self.form('/login/username', 'username')
+        elif url.path == '/login/username':
+            self.form('/login/password', 'password')
+        elif url.path == '/login/password':
+            self.send('', status=302, headers=[('Location', self.base() + '/portal/'), ('Set-Cookie', 'PHPSESSID=bench; Path=/')])
+        else:
+            self.send('not found', status=404)
+
+    def api(self, query):
+        fixtures = self.server.fixtures
+        method = query.get('method')
+        if method == 'profiles.getProfileContext':
+            return {'institutions': [{'institutionCode': '101', 'institutionProfileId': 1, 'children': [{'id': 2}]}]}
+        if method == 'posts.getAllPosts':
+            page, limit = int(query.get('index', 0)), int(query.get('limit', aula.page_size))
+            return {'posts': fixtures['posts'][page * limit:(page + 1) * limit]}
+        if method == 'messaging.getThreads':
+            page = int(query.get('page', 0))
+            return {'threads': fixtures['threads'][page * aula.page_size:(page + 1) * aula.page_size]}
+        if method == 'messaging.getMessagesForThread':
+            page = int(query.get('page', 0))
+            messages = fixtures['messages'].get(query.get('threadId'), [])
+            return {'messages': messages[page * 20:(page + 1) * 20], 'moreMessagesExist': len(messages) > (page + 1) * 20}
+        return []
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    # aula.py makes up to 8 requests at once, more than the default listen
+    # backlog of 5, and a refused connection is only retried after a second
+    request_queue_size = 64
+
+def start_server(fixtures, api_latency=0.0):
+    server = StandInServer(('127.0.0.1', 0), AulaStandIn)
+    server.fixtures = fixtures
+    server.api_latency = api_latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FakeModel:
+    # Deterministic stand-in for GPT4All, the answer only depends on the prompt.
+    # Reading the prompt takes prompt_latency seconds per 1000 characters and
+    # each generated token token_latency seconds.
+    def __init__(self, prompt_latency=0.0, token_latency=0.0):
+        self.prompt_latency = prompt_latency
+        self.token_latency = token_latency
+
+    @contextlib.contextmanager
+    def chat_session(self, system_prompt=None, prompt_template=None):
+        yield self
+
+    def answer(self, prompt):
+        digest = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        return "Summary: Besked %s om %s.\nImportant: %s\nCategory: info\nDeadline: none" % (
+            digest[:6], words[int(digest[6:8], 16) % len(words)], "yes" if int(digest[8], 16) < 4 else "no")
+
+    def tokens(self, prompt, max_tokens, callback):
+        time.sleep(self.prompt_latency * len(prompt) / 1000)
+        for token in re.findall(r'\s*\S+', self.answer(prompt))[:max_tokens]:
+            time.sleep(self.token_latency)
+            if callback is not None:
+                callback(0, token)
+            yield token
+
+    def generate(self, prompt, max_tokens=200, streaming=False, callback=None, **kwargs):
+        tokens = self.tokens(prompt, max_tokens, callback)
+        return tokens if streaming else "".join(tokens)
+
+class FakeEmbedder:
+    # Deterministic stand-in for Embed4All: hashed bag of words
+    def embed(self, texts):
+        vectors = []
+        for text in texts:
+            vector = [0.0] * 256
+            for word in dedup.words(text).split():
+                vector[int(hashlib.md5(word.encode('utf-8')).hexdigest()[:4], 16) % 256] += 1
+            vectors.append(vector)
+        return vectors
+
+def timed(module, name, stage, timings, saved):
+    # Replace module.name by a wrapper adding its running time to timings[stage]
+    function = getattr(module, name)
+    saved.append((module, name, function))
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+    setattr(module, name, wrapper)
+
+def run_once(fixtures, prompt_latency, token_latency, api_latency):
+    # One run of get_data() against the stand-in with a fresh session and store.
+    # Returns the seconds spent in each stage and the number of items shown.
+    server = start_server(fixtures, api_latency)
+    base = 'http://127.0.0.1:%d' % server.server_address[1]
+    timings = {}
+    saved = [(module, name, getattr(module, name)) for module, name in
+             ((aula, 'api_url'), (aula, 'login_url'), (aula, 'portal_url'), (aula, 'session_file'), (aula, 'user'),
+              (aila, 'store'), (aila, 'model'), (aila, 'inference_workers'), (dedup, 'embedder'), (dedup, 'use_embeddings'))]
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            aula.api_url = base + '/api/'
+            aula.login_url = base + '/auth/login.php?type=unilogin'
+            aula.portal_url = base + '/portal/'
+            aula.session_file = os.path.join(directory, 'aula_session.json')
+            aula.user = {'username': 'bench', 'password': 'bench'}
+            aila.store = Store(os.path.join(directory, 'aila.db'))
+            aila.model = FakeModel(prompt_latency, token_latency)
+            aila.inference_workers = 1
+            dedup.embedder = FakeEmbedder()
+            dedup.use_embeddings = True
+            timed(aula, 'login', 'login', timings, saved)
+            timed(aula, 'run', 'fetch', timings, saved)
+            timed(aila, 'strip_html', 'html', timings, saved)
+            timed(dedup, 'group', 'dedup', timings, saved)
+            timed(aila, 'classify', 'inference', timings, saved)
+            timed(aila, 'summarize_daily', 'summary', timings, saved)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                posts, msgs, daily_summary = aila.get_data()
+                # the text output of --once, the window is not benchmarked
+                formatting = time.perf_counter()
+                aila.print_result(posts, msgs, daily_summary)
+                timings['format'] = time.perf_counter() - formatting
+            timings['total'] = time.perf_counter() - start
+            # the login is part of aula.run()
+            timings['fetch'] = timings.get('fetch', 0) - timings.get('login', 0)
+            aila.store.close()
+        finally:
+            for module, name, value in reversed(saved):
+                setattr(module, name, value)
+            server.shutdown()
+            server.server_close()
+    return timings, len(posts) + len(msgs)
+
+def benchmark(fixtures, repeat=3, prompt_latency=0.0, token_latency=0.0, api_latency=0.0):
+    # median seconds of each stage over repeat runs, and the number of items shown
+    runs = [run_once(fixtures, prompt_latency, token_latency, api_latency) for i in range(repeat)]
+    result = {}
+    for stage in stages + ['total']:
+        values = sorted(timings.get(stage, 0.0) for timings, items in runs)
+        result[stage] = values[len(values) // 2]
+    return result, runs[0][1]
+
+def compare(result, baseline):
+    # lines of the report and the stages that regressed
+    lines = []
+    regressions = []
+    for stage in stages + ['total']:
+        line = "%-10s %8.3fs" % (stage, result[stage])
+        if baseline and stage in baseline:
+            change = (result[stage] - baseline[stage]) / baseline[stage] if baseline[stage] else 0.0
+            line += "  baseline %8.3fs  %+6.1f%%" % (baseline[stage], 100 * change)
+            if change > tolerance and result[stage] - baseline[stage] > min_difference:
+                line += "  REGRESSION"
+                regressions.append(stage)
+        lines.append(line)
+    return lines, regressions
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Offline benchmark of Aila')
+    arg_parser.add_argument('--posts', type=int, default=100, help='number of synthesized posts (default 100)')
+    arg_parser.add_argument('--threads', type=int, default=50, help='number of synthesized threads (default 50)')
+    arg_parser.add_argument('--replies', type=int, default=3, help='messages per synthesized thread (default 3)')
+    arg_parser.add_argument('--duplicates', type=float, default=0.2, help='fraction of posts that copy an earlier post (default 0.2)')
+    arg_parser.add_argument('--fixtures', help='JSON file with recorded posts and threads instead of synthesized ones')
+    arg_parser.add_argument('--record', metavar='FILE', help='write the fixtures used to FILE')
+    arg_parser.add_argument('--prompt-latency', type=float, default=0.001, help='fake LLM seconds per 1000 prompt characters (default 0.001)')
+    arg_parser.add_argument('--token-latency', type=float, default=0.0005, help='fake LLM seconds per generated token (default 0.0005)')
+    arg_parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to each API request (default 0)')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='number of runs, the median is reported (default 3)')
+    arg_parser.add_argument('--baseline', default=baseline_file, help='baseline file (default %s)' % baseline_file)
+    arg_parser.add_argument('--save-baseline', action='store_true', help='store the result as the baseline of this configuration')
+    args = arg_parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures, 'r') as file:
+            fixtures = json.load(file)
+        fixtures.setdefault('messages', {})
+        name = "fixtures=%s" % os.path.basename(args.fixtures)
+    else:
+        fixtures = synthesize(args.posts, args.threads, args.replies, args.duplicates)
+        name = "posts=%d threads=%d replies=%d duplicates=%g" % (args.posts, args.threads, args.replies, args.duplicates)
+    name += " prompt=%g token=%g api=%g" % (args.prompt_latency, args.token_latency, args.api_latency)
+    if args.record:
+        with open(args.record, 'w') as file:
+            json.dump(fixtures, file, ensure_ascii=False)
+
+    result, items = benchmark(fixtures, args.repeat, args.prompt_latency, args.token_latency, args.api_latency)
+    try:
+        with open(args.baseline, 'r') as file:
+            baselines = json.load(file)
+    except (OSError, ValueError):
+        baselines = {}
+
+    print(name)
+    print("%d items shown, median of %d runs" % (items, args.repeat))
+    lines, regressions = compare(result, baselines.get(name))
+    print("\n".join(lines))
+    if args.save_baseline:
+        baselines[name] = result
+        with open(args.baseline, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print("baseline saved to %s" % args.baseline)
+    elif name not in baselines:
+        print("no baseline for this configuration, store one with --save-baseline")
+    sys.exit(1 if regressions and not args.save_baseline else 0)
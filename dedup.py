@@ -0,0 +1,151 @@
+# dedup.py
+#
+# Near-duplicate detection. The same announcement often arrives as several
+# posts to different children or institutions, or as a post and a message.
+# The texts are embedded with a small local embedding model (GPT4All's
+# Embed4All) and texts whose embeddings are close are grouped, so the LLM only
+# reads each announcement once. The embeddings of texts read in earlier runs
+# are kept in the store for the retention window, and a copy arriving later
+# gets the result of the earlier one. Texts with different numbers or dates,
+# like the same meeting on another day, are never grouped.
+#
+# The embeddings need gpt4all and NumPy. Without them only copies with the
+# same words are grouped.
+
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Cosine similarity of the embeddings above which two texts are the same announcement
+threshold = 0.95
+
+# Words that tell recurring announcements apart, e.g. a parent meeting on
+# Tuesday at 17 and one on Wednesday at 18. Texts are only grouped if these and
+# their numbers are the same.
+date_words = set(('mandag tirsdag onsdag torsdag fredag lørdag søndag idag dag morgen overmorgen '
+                  'januar februar marts april maj juni juli august september oktober november december '
+                  'jan feb mar apr jun jul aug sep sept okt nov dec').split())
+
+# Set to False to only group copies with the same words
+use_embeddings = True
+
+embedder = None
+
+# In batch mode (see batch.py) the embeddings are made by the model service
+# shared by all accounts, and service is the client of that service
+service = None
+
+# Number of texts grouped with an earlier text in the current run
+stats = {'duplicates': 0}
+
+def get_embedder():
+    # The embedding model is loaded on first use, None if it is not available
+    global embedder, use_embeddings
+    if embedder is None and use_embeddings and numpy is not None:
+        try:
+            from gpt4all import Embed4All
+            embedder = Embed4All()
+        except Exception as e:
+            print("embeddings not available: %r" % e, file=sys.stderr)
+            use_embeddings = False
+    return embedder
+
+def words(text):
+    return " ".join(re.findall(r'\w+', text.lower()))
+
+def details(text):
+    # the numbers and date words of a text, in order
+    return " ".join(word for word in words(text).split() if word in date_words or any(c.isdigit() for c in word))
+
+def embeddings(texts):
+    # The embeddings of the texts as lists, None without an embedding model
+    if not use_embeddings:
+        return None
+    if service is not None:
+        return service.call('embeddings', texts)
+    if get_embedder() is None:
+        return None
+    return embedder.embed(texts)
+
+def embed(texts):
+    # Unit length embeddings of the texts as the rows of a matrix, or None
+    if not texts or numpy is None:
+        return None
+    vectors = embeddings(texts)
+    if vectors is None:
+        return None
+    vectors = numpy.array(vectors, dtype=numpy.float32)
+    return vectors / numpy.maximum(numpy.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def group(texts, earlier=()):
+    # Group the texts into clusters of near-duplicates. earlier holds
+    # (vector, details, result) of the texts read in earlier runs, vector as
+    # bytes. Returns a list of (indices, vector, result), one per cluster in
+    # order of its first text: the indices of the texts in the cluster, the
+    # embedding of the first text as bytes (None without embeddings) and the
+    # result of an earlier copy, or None if the cluster must be read by the LLM.
+    # Only texts with the same details() are grouped.
+    vectors = embed(texts)
+    keys = [details(text) for text in texts]
+    known = []
+    known_keys = []
+    results = []
+    if vectors is not None:
+        for vector, key, result in earlier:
+            vector = numpy.frombuffer(vector, dtype=numpy.float32)
+            if vector.shape == vectors.shape[1:]:
+                known.append(vector)
+                known_keys.append(key)
+                results.append(result)
+    known = numpy.array(known) if known else None
+
+    clusters = []
+    leaders = [] # row of the first text of each cluster in vectors
+    by_words = {}
+    for i, text in enumerate(texts):
+        # copies with the same words, then the closest cluster of this run,
+        # then the closest text of an earlier run
+        cluster = by_words.get(words(text))
+        if cluster is None and leaders:
+            similarity = vectors[leaders] @ vectors[i]
+            similarity[numpy.array([keys[leader] != keys[i] for leader in leaders])] = -1
+            if similarity.max() >= threshold:
+                cluster = int(similarity.argmax())
+        if cluster is not None:
+            clusters[cluster][0].append(i)
+            stats['duplicates'] += 1
+            continue
+        result = None
+        if known is not None:
+            similarity = known @ vectors[i]
+            similarity[numpy.array([key != keys[i] for key in known_keys])] = -1
+            if similarity.max() >= threshold:
+                result = results[int(similarity.argmax())]
+                stats['duplicates'] += 1
+        by_words[words(text)] = len(clusters)
+        if vectors is not None:
+            leaders.append(i)
+        clusters.append(([i], vectors[i].tobytes() if vectors is not None else None, result))
+    return clusters
+
+def nearest(text, vectors, limit=20):
+    # The keys of the limit vectors closest to the embedding of the text, closest
+    # first. vectors holds (key, vector) with vector as bytes. None without embeddings.
+    query = embed([text])
+    if query is None:
+        return None
+    vectors = [(key, numpy.frombuffer(vector, dtype=numpy.float32)) for key, vector in vectors]
+    vectors = [(key, vector) for key, vector in vectors if vector.shape == query.shape[1:]]
+    if not vectors:
+        return []
+    similarity = numpy.array([vector for key, vector in vectors]) @ query[0]
+    return [vectors[i][0] for i in numpy.argsort(-similarity)[:limit]]
+
+def report():
+    if not stats['duplicates']:
+        return ""
+    return "%d duplicates read once" % stats['duplicates']
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Aila: AI for Aula
+-------
+
+The Tk window of Aila. It is shown by running `python aila.py` without options.
+
+Copyright (c) 2023 Stefan Sommer. Distributed under the MIT License, see LICENSE.
+
+"""
+
+import aila
+import aula
+import prefilter
+import dedup
+import metrics
+
+import tkinter as tk
+import tkinter.font as tkFont
+from datetime import datetime, timedelta
+import threading
+import queue
+import time
+import sys
+
+# the window and its widgets, created by build()
+root = None
+text_widget = None
+status_label = None
+cancel_button = None
+search_entry = None
+
+# Fetching and inference run on a worker thread. It posts its progress to the
+# events queue, which the Tk event loop drains with poll_events().
+events = queue.Queue()
+worker = None
+cancel = threading.Event()
+
+# posts, messages and daily summary shown since the last full run; runs started
+# by new notifications add to them
+shown = ([], [], "")
+
+# Number of archived items shown per page of older history, and the number of
+# items kept in the window. Beyond it the oldest items are dropped; they can be
+# paged in again, so the window never holds more than the user asked for.
+page_size = 20
+max_items = 200
+
+# the items in the window, oldest first, as (number, (kind, id), time). The
+# number names the tags of the item: 'item<number>' covers the item and
+# 'original<number>' its original text, which is hidden until the item is clicked.
+rendered = []
+item_count = 0
+
+def build():
+    global root, text_widget, status_label, cancel_button, search_entry
+    # Create a Tkinter window
+    root = tk.Tk()
+    root.title("aila: AI for Aula")
+    output = "aila: AI for Aula\n\n"
+
+    # Set window size (width x height)
+    root.geometry("600x600")
+
+    ## Create a label widget to display the text
+    #label = tk.Label(root, text=output, wraplength=600, anchor='nw', justify='left')
+    #label.pack(expand=True, fill="both")
+
+    # Create a status line with progress and a button to cancel the run
+    status_frame = tk.Frame(root)
+    status_label = tk.Label(status_frame, text="", anchor='w')
+    cancel_button = tk.Button(status_frame, text="Cancel", command=cancel_run, state=tk.DISABLED)
+    status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+    cancel_button.pack(side=tk.RIGHT)
+    status_frame.pack(side=tk.TOP, fill=tk.X)
+
+    # Create a search box for the archive of earlier posts and messages
+    search_frame = tk.Frame(root)
+    search_entry = tk.Entry(search_frame)
+    search_entry.bind('<Return>', lambda event: show_search())
+    search_button = tk.Button(search_frame, text="Search", command=show_search)
+    search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+    search_button.pack(side=tk.RIGHT)
+    search_frame.pack(side=tk.TOP, fill=tk.X)
+
+    # Create a Text widget and a Scrollbar
+    text_widget = tk.Text(root, wrap=tk.WORD, state=tk.DISABLED)
+    scrollbar = tk.Scrollbar(root, command=text_widget.yview)
+
+    # Configure the Text widget to work with the Scrollbar
+    text_widget.configure(yscrollcommand=scrollbar.set)
+    # Define a tag for bold text
+    default_font = tkFont.nametofont("TkTextFont")
+    bold_font = default_font.copy()
+    bold_font.configure(weight="bold")
+    text_widget.tag_configure("bold", font=bold_font)
+    text_widget.tag_configure("original", lmargin1=20, lmargin2=20, foreground="gray35")
+    text_widget.tag_configure("older", foreground="blue", underline=True)
+    # Clicking an item or its original text shows or hides the original text
+    text_widget.tag_bind("item", "<Button-1>", toggle_original)
+    text_widget.tag_bind("original", "<Button-1>", toggle_original)
+    text_widget.tag_bind("older", "<Button-1>", lambda event: show_older())
+
+    # The text is a header, a line to show older messages and the messages,
+    # oldest first. The header ends at the 'header' mark and older messages are
+    # inserted at the 'older' mark, which stays in front of what is inserted.
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert(tk.END, output)
+    text_widget.mark_set('header', 'end-1c')
+    text_widget.insert(tk.END, "Show older messages\n", ("older",))
+    text_widget.mark_set('older', 'end-1c')
+    text_widget.mark_gravity('older', tk.LEFT)
+    text_widget.config(state=tk.DISABLED)
+
+    # Layout the widgets in the window
+    text_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+    scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+def set_header(text):
+    # Replace the header, the messages below it are left alone
+    text_widget.config(state=tk.NORMAL)
+    text_widget.delete('1.0', 'header')
+    text_widget.insert('1.0', text)
+    text_widget.config(state=tk.DISABLED)
+
+def init_text():
+    # initial text
+    set_header("Getting data from Aula and running LLM... (this might take a while)\n\n")
+
+def item_text(item):
+    # The arguments of Text.insert() for an item: its line, and its original
+    # text which is hidden until the item is clicked
+    global item_count
+    item_count += 1
+    text_widget.tag_configure("original%d" % item_count, elide=True)
+    rendered_item = (item_count, (item['kind'], str(item['id'])), item['time'])
+    line_tags = ("item", "item%d" % item_count) + (("bold",) if item['important'] else ())
+    return rendered_item, (aila.format_hit(item), line_tags,
+                           item['text'] + "\n\n", ("original", "item%d" % item_count, "original%d" % item_count))
+
+def toggle_original(event):
+    # Show or hide the original text of the clicked item
+    for tag in text_widget.tag_names("@%d,%d" % (event.x, event.y)):
+        if tag.startswith("item") and tag != "item":
+            original = "original" + tag[len("item"):]
+            hidden = text_widget.tag_cget(original, "elide") in ("1", "true", True)
+            text_widget.tag_configure(original, elide=not hidden)
+
+def drop_items(newest=False):
+    # Remove the items beyond max_items from the window, the oldest ones or,
+    # when older items were paged in, the newest ones
+    while len(rendered) > max_items:
+        number = rendered.pop(-1 if newest else 0)[0]
+        ranges = text_widget.tag_ranges("item%d" % number)
+        if ranges:
+            text_widget.delete(ranges[0], ranges[-1])
+        text_widget.tag_delete("item%d" % number, "original%d" % number)
+
+def show_older():
+    # Page in the archived items before the oldest item in the window. Items
+    # with the same time as the oldest one are fetched again and skipped if shown.
+    before = min((when for number, key, when in rendered), default=None)
+    keys = {key for number, key, when in rendered}
+    hits = aila.get_store().recent(before, page_size + sum(1 for number, key, when in rendered if when == before))
+    hits = [hit for hit in hits if (hit['kind'], str(hit['id'])) not in keys][:page_size]
+    if not hits:
+        status_label.config(text="No older messages.")
+        return
+    page = []
+    args = []
+    for hit in reversed(hits):
+        rendered_item, item_args = item_text(hit)
+        page.append(rendered_item)
+        args += item_args
+    rendered[:0] = page
+    # the whole page is inserted in one call, above the items already shown
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert('older', *args)
+    drop_items(newest=True)
+    text_widget.config(state=tk.DISABLED)
+
+def start_live(text):
+    # Start a line the tokens of the LLM are streamed into. The 'live' mark stays
+    # at its start while text is appended after it.
+    text_widget.config(state=tk.NORMAL)
+    text_widget.mark_set('live', 'end-1c')
+    text_widget.mark_gravity('live', tk.LEFT)
+    text_widget.insert(tk.END, text)
+    text_widget.config(state=tk.DISABLED)
+
+def append_token(token):
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert(tk.END, token)
+    text_widget.config(state=tk.DISABLED)
+    text_widget.see(tk.END)
+
+def clear_live():
+    # Remove the streamed line, if any
+    if 'live' in text_widget.mark_names():
+        text_widget.config(state=tk.NORMAL)
+        text_widget.delete('live', 'end-1c')
+        text_widget.mark_unset('live')
+        text_widget.config(state=tk.DISABLED)
+
+def append_item(item):
+    # Show a message as soon as the worker has processed it, in place of the
+    # streamed line. Only the new item is inserted, the tags are given with the
+    # inserted text so no index arithmetic is needed.
+    clear_live()
+    if (item['kind'], str(item['id'])) in {key for number, key, when in rendered}:
+        return
+    rendered_item, args = item_text(item)
+    rendered.append(rendered_item)
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert(tk.END, *args)
+    drop_items()
+    text_widget.config(state=tk.DISABLED)
+    text_widget.see(tk.END)
+
+def update_text(important,daily_summary):
+    # Update the header with the state of the messages since the last full run
+    header = "Updated at " + time.strftime("%H:%M:%S") + " (" + ", ".join(filter(None, [aula.latency_report(), prefilter.report(), dedup.report()])) + ").\n\n"
+    if important:
+        header += "Some messages seems to be important. You might want to check them out. "
+        if daily_summary:
+            header += "Summary:\n" + daily_summary + "\n\n\n"
+        else:
+            header += "\n"
+    if not important:
+        header += "No important messages found - you likely didn't miss anything.\n"
+    set_header(header + "Click a message to see the original text.\n\n")
+
+def work(full):
+    # Runs on the worker thread, everything is passed to the GUI through events
+    try:
+        result = aila.poll_data(lambda *event: events.put(event), cancel, full)
+        events.put(('done', full, result))
+    except Exception as e:
+        metrics.error('run', e)
+        events.put(('error', e))
+
+def show_result(full, result):
+    # Show the result of a run. A full run replaces what is shown, a run started
+    # by new notifications adds to it and raises the window if anything is important.
+    global shown
+    if result is None:
+        return
+    posts, msgs, daily_summary = result
+    if full:
+        shown = result
+    else:
+        shown = (shown[0] + posts, shown[1] + msgs, daily_summary or shown[2])
+    clear_live()
+    update_text(any(item['important'] for item in shown[0] + shown[1]), shown[2])
+    if not full and any(item['important'] for item in posts + msgs):
+        root.bell()
+        root.deiconify()
+        root.lift()
+
+def poll_events():
+    # Apply the events of the worker to the window, the Tk event loop stays responsive
+    try:
+        while True:
+            event = events.get_nowait()
+            if event[0] == 'progress':
+                done, total = event[1:]
+                status_label.config(text="Running LLM on message %d of %d..." % (min(done + 1, total), total) if done < total else "Making summary...")
+            elif event[0] == 'start':
+                start_live("%s, %s: " % (event[1]['title'], event[1]['sender']))
+            elif event[0] == 'token' or event[0] == 'summary-token':
+                append_token(event[1])
+            elif event[0] == 'item':
+                append_item(event[1])
+            elif event[0] == 'summary-start':
+                status_label.config(text="Making summary...")
+                start_live("\nSummary:\n")
+            elif event[0] == 'done':
+                show_result(*event[1:])
+                finish("Cancelled." if cancel.is_set() else "")
+            elif event[0] == 'error':
+                print(event[1], file=sys.stderr)
+                clear_live()
+                finish("Failed: %s" % event[1])
+    except queue.Empty:
+        pass
+    if worker is not None:
+        root.after(100, poll_events)
+
+def finish(status):
+    global worker
+    worker = None
+    status_label.config(text=status)
+    cancel_button.config(state=tk.DISABLED)
+
+def show_search():
+    # Show the archived posts and messages matching the search box in a window of their own
+    query = search_entry.get().strip()
+    if not query:
+        return
+    hits = aila.search(query)
+    window = tk.Toplevel(root)
+    window.title("aila: " + query)
+    window.geometry("600x400")
+    results = tk.Text(window, wrap=tk.WORD)
+    scrollbar = tk.Scrollbar(window, command=results.yview)
+    results.configure(yscrollcommand=scrollbar.set)
+    results.tag_configure("bold", font=text_widget.tag_cget("bold", "font"))
+    for hit in hits:
+        results.insert(tk.END, aila.format_hit(hit), ("bold",) if hit['important'] else ())
+    if not hits:
+        results.insert(tk.END, "No messages found.\n")
+    results.config(state=tk.DISABLED)
+    results.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+    scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+def cancel_run():
+    # The worker stops after the message it is processing
+    cancel.set()
+    status_label.config(text="Cancelling...")
+    cancel_button.config(state=tk.DISABLED)
+
+def run_task(full=True):
+    # Scheduled task to run, starts the worker unless it is already running. A
+    # full run fetches everything, otherwise only what new notifications point to.
+    #print("Task running... " + datetime.now().isoformat())
+    global worker
+    if worker is not None:
+        return
+    if full:
+        init_text()
+    status_label.config(text="Getting data from Aula..." if full else "Checking for new messages...")
+    cancel_button.config(state=tk.NORMAL)
+    cancel.clear()
+    worker = threading.Thread(target=work, args=(full,), daemon=True)
+    worker.start()
+    root.after(100, poll_events)
+
+    #with open("last_run_time.json", "w") as file:
+    #    # Save the current time as the last run time
+    #    json.dump({"last_run": datetime.now().isoformat()}, file)
+
+# last time check_run() was exectued
+global last_run_time
+last_run_time = datetime.now() - timedelta(hours=25)
+# last time the notifications were checked
+last_poll_time = datetime.now()
+
+def check_run():
+    global last_run_time, last_poll_time
+    #try:
+    #    with open("last_run_time.json", "r") as file:
+    #        last_run_time = datetime.fromisoformat(json.load(file)["last_run"])
+    #except (FileNotFoundError, ValueError, KeyError):
+    #    last_run_time = datetime.now() - timedelta(hours=25)
+
+    if worker is not None:
+        pass
+    elif datetime.now() - last_run_time > timedelta(hours=24):
+        run_task()
+        last_run_time = last_poll_time = datetime.now()
+    elif aila.poll_minutes and datetime.now() - last_poll_time > timedelta(minutes=aila.poll_minutes):
+        run_task(full=False)
+        last_poll_time = datetime.now()
+
+    # Schedule the next check in 1 minute (60000 milliseconds)
+    root.after(60000, check_run)
+
+def main():
+    build()
+    # show the newest messages of earlier runs while Aula is contacted
+    show_older()
+
+    # Start the check loop
+    root.after(1000, check_run)
+
+    # Start the GUI event loop
+    root.mainloop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# metrics.py
+#
+# Timing spans, counters and events of the fetch and inference pipeline, so it
+# can be seen where the time of a run goes and when Aula or the model slows
+# down. Every span and event can be written as a line of JSON to log_file. The
+# totals are exported in the Prometheus text format to prometheus_file after
+# each run and, once serve() is called, on http://localhost:<port>/metrics.
+#
+# The totals are kept per process. Inference worker and account processes (see
+# pool.py and batch.py) only write their spans and events to the JSON log.
+
+import http.server
+import threading
+import json
+import time
+import os
+from contextlib import contextmanager
+
+# file the JSON lines are appended to, None to not log
+log_file = None
+# file the Prometheus text is written to by flush(), None to not write it
+prometheus_file = None
+
+# metrics are named aila_<name>
+prefix = 'aila_'
+
+lock = threading.Lock()
+# by (name, labels): counters, and count, sum and maximum of observed values
+counters = {}
+observations = {}
+
+def key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def log(event, **fields):
+    # Write an event as a line of JSON to the log
+    if log_file is None:
+        return
+    line = json.dumps(dict(time=round(time.time(), 3), event=event, pid=os.getpid(), **fields), ensure_ascii=False, default=str)
+    with lock, open(log_file, 'a') as file:
+        file.write(line + "\n")
+
+def error(where, e, **fields):
+    # Count and log a failure that is handled, so it is not lost
+    count('errors', where=where)
+    log('error', where=where, error=repr(e), **fields)
+
+def count(name, value=1, **labels):
+    with lock:
+        counters[key(name, labels)] = counters.get(key(name, labels), 0) + value
+
+def observe(name, value, **labels):
+    with lock:
+        observation = observations.setdefault(key(name, labels), [0, 0.0, 0.0])
+        observation[0] += 1
+        observation[1] += value
+        observation[2] = max(observation[2], value)
+
+@contextmanager
+def span(name, **labels):
+    # Time the block as <name>_seconds and log it. The block gets a dict to add
+    # fields to the log line; an exception leaving the block is logged and counted.
+    fields = {}
+    start = time.perf_counter()
+    try:
+        yield fields
+    except Exception as e:
+        fields['error'] = repr(e)
+        count(name + '_errors', **labels)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe(name + '_seconds', seconds, **labels)
+        log('span', span=name, seconds=round(seconds, 6), **dict(labels, **fields))
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for label, value in labels) + "}"
+
+def prometheus():
+    # The totals in the Prometheus text format
+    lines = []
+    with lock:
+        names = sorted(set(name for name, labels in counters))
+        for name in names:
+            lines.append("# TYPE %s%s_total counter" % (prefix, name))
+            lines += ["%s%s_total%s %s" % (prefix, name, label_text(labels), value)
+                      for (n, labels), value in sorted(counters.items()) if n == name]
+        names = sorted(set(name for name, labels in observations))
+        for name in names:
+            lines.append("# TYPE %s%s summary" % (prefix, name))
+            for (n, labels), (number, total, maximum) in sorted(observations.items()):
+                if n == name:
+                    lines.append("%s%s_count%s %d" % (prefix, name, label_text(labels), number))
+                    lines.append("%s%s_sum%s %.6f" % (prefix, name, label_text(labels), total))
+            lines.append("# TYPE %s%s_max gauge" % (prefix, name))
+            lines += ["%s%s_max%s %.6f" % (prefix, name, label_text(labels), maximum)
+                      for (n, labels), (number, total, maximum) in sorted(observations.items()) if n == name]
+    return "\n".join(lines) + "\n"
+
+def flush():
+    # Write the totals to prometheus_file, replacing it in one step so a
+    # collector never reads half a file
+    if prometheus_file is None:
+        return
+    tmp = prometheus_file + '.tmp'
+    with open(tmp, 'w') as file:
+        file.write(prometheus())
+    os.replace(tmp, prometheus_file)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port):
+    # Serve the totals on http://localhost:<port>/metrics from a background thread
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
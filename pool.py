@@ -0,0 +1,111 @@
+# pool.py
+#
+# Parallel inference for Aila. A pool of worker processes each loads its own
+# model and runs messages through it, so several messages are processed at
+# the same time on a machine with many cores. The model file is memory mapped,
+# so the workers share the model weights in memory; each worker adds its own
+# context (KV cache), which grows with n_ctx.
+#
+# Run `python pool.py --benchmark` to measure the throughput of different
+# splits of the cores between workers and threads.
+
+import multiprocessing
+import argparse
+import os
+import time
+
+def init_worker(settings, store_file, preload, log_file=None):
+    # Runs in each worker process when it starts
+    import aila
+    import metrics
+    from store import Store
+    metrics.log_file = log_file
+    for name, value in settings.items():
+        setattr(aila, name, value)
+    if store_file:
+        aila.store = Store(store_file)
+    if preload:
+        aila.get_model()
+
+def work(task):
+    # the seconds the text waited for a worker since it was sent, and the result
+    import aila
+    text, sent = task
+    return time.time() - sent, aila.run_llm(text)
+
+def call(name, text):
+    # aila.run_llm(), aila.run_llm_daily() or dedup.embeddings() on text, requested by name
+    if name == 'embeddings':
+        import dedup
+        return dedup.embeddings(text)
+    import aila
+    return getattr(aila, name)(text)
+
+class InferencePool:
+    def __init__(self, workers, threads=None, store_file=None, preload=False):
+        # workers processes with a model using threads CPU threads each.
+        # store_file is the store used for the summaries of long messages.
+        import aila
+        import metrics
+        settings = {name: getattr(aila, name) for name in aila.model_settings}
+        settings['n_threads'] = threads
+        self.workers = workers
+        self.threads = threads
+        self.pool = multiprocessing.get_context('spawn').Pool(workers, init_worker, (settings, store_file, preload, metrics.log_file))
+
+    def imap(self, texts):
+        # (seconds waited for a worker, result of aila.run_llm()) for the texts, in order
+        return self.pool.imap(work, [(text, time.time()) for text in texts])
+
+    def submit(self, name, text, callback, error_callback):
+        # run call(name, text) on the next free worker, the result is passed to callback
+        self.pool.apply_async(call, (name, text), callback=callback, error_callback=error_callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def splits(cores):
+    # (workers, threads) splits of the cores, from one worker with all threads
+    # to one thread per worker
+    workers = 1
+    while workers <= cores:
+        yield workers, cores // workers
+        workers *= 2
+
+def benchmark(texts, cores):
+    # messages per second for each split of the cores, measured after the models are loaded
+    results = []
+    for workers, threads in splits(cores):
+        pool = InferencePool(workers, threads, preload=True)
+        try:
+            # one message per worker makes sure all workers have started and loaded their model
+            list(pool.imap(texts[:workers]))
+            start = time.perf_counter()
+            list(pool.imap(texts))
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.close()
+        results.append((workers, threads, len(texts) / elapsed))
+        print("%2d workers x %2d threads: %.3f messages/s" % results[-1], flush=True)
+    return results
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark parallel inference of Aila')
+    arg_parser.add_argument('--benchmark', action='store_true', help='run the benchmark')
+    arg_parser.add_argument('--cores', type=int, default=os.cpu_count(), help='number of cores to use (default all)')
+    arg_parser.add_argument('--messages', type=int, default=16, help='number of messages to process per split')
+    args = arg_parser.parse_args()
+    if args.benchmark:
+        import aila
+        # benchmark on the messages of earlier runs, or on a sample message
+        texts = [text for text, important in aila.get_store().verdicts()] or ["Husk forældremøde tirsdag kl. 17 i klassen."]
+        texts = (texts * args.messages)[:args.messages]
+        best = max(benchmark(texts, args.cores), key=lambda result: result[2])
+        print("best: %d workers x %d threads" % best[:2])
+    else:
+        arg_parser.print_help()
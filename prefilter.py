@@ -0,0 +1,92 @@
+# prefilter.py
+#
+# Cheap first stage in front of the LLM. Keyword rules and a small naive Bayes
+# model over the (mostly Danish) message text decide whether a message is
+# clearly unimportant. Only ambiguous or likely important messages are sent on
+# to the LLM. The model is trained on the verdicts the LLM gave earlier.
+
+import re
+import math
+from collections import Counter
+
+# Messages matching these are never skipped
+important_patterns = re.compile(
+    r'forældremøde|fødselsdag|møde|samtale|frist|deadline|tilmeld|husk|lukke|lukket|aflys|udflugt|tur\b|'
+    r'ferie|fridag|syg|lus\b|vaccin|underskriv|betal|medbring|birthday|meeting', re.IGNORECASE)
+
+# Messages matching these (and not the patterns above) are candidates for skipping
+unimportant_patterns = re.compile(
+    r'madplan|menu|frokost|mad\b|hittegods|glemt|mistet|fundet|bortkommen|savner|har nogen set|'
+    r'nyhedsbrev|billeder fra|lost|found', re.IGNORECASE)
+
+# The model only overrules the rules once it has seen this many verdicts
+min_samples = 50
+# Probability of being important below which a message is skipped by the model
+skip_below = 0.05
+
+# Number of messages sent to the LLM and skipped in the current run
+stats = {'llm': 0, 'skipped': 0}
+
+def tokenize(text):
+    return re.findall(r'[a-zæøå0-9]+', text.lower())
+
+class Classifier:
+    # Multinomial naive Bayes with add-one smoothing, a linear model in log space
+    def __init__(self):
+        self.words = {True: Counter(), False: Counter()}
+        self.docs = {True: 0, False: 0}
+
+    def train(self, samples):
+        # samples is an iterable of (text, important)
+        for text, important in samples:
+            important = bool(important)
+            self.words[important].update(tokenize(text))
+            self.docs[important] += 1
+
+    def trained(self):
+        return self.docs[True] > 0 and self.docs[False] > 0 and sum(self.docs.values()) >= min_samples
+
+    def probability(self, text):
+        # Probability that the text is important
+        vocabulary = len(set(self.words[True]) | set(self.words[False])) or 1
+        score = {}
+        for label in (True, False):
+            total = sum(self.words[label].values())
+            score[label] = math.log((self.docs[label] + 1) / (sum(self.docs.values()) + 2))
+            for word in tokenize(text):
+                score[label] += math.log((self.words[label][word] + 1) / (total + vocabulary))
+        diff = max(min(score[False] - score[True], 700), -700)
+        return 1 / (1 + math.exp(diff))
+
+classifier = Classifier()
+
+def train(samples):
+    # Retrain the model from scratch on the given (text, important) verdicts
+    global classifier
+    classifier = Classifier()
+    classifier.train(samples)
+
+def route(text):
+    # Returns 'llm' if the message must be read by the LLM and 'skip' if it is
+    # clearly unimportant, and counts the decision in stats
+    decision = 'llm'
+    if not important_patterns.search(text):
+        unimportant = unimportant_patterns.search(text)
+        if classifier.trained():
+            # the model skips what it is sure of, and decides on the rule matches
+            probability = classifier.probability(text)
+            if probability < skip_below or (unimportant and probability < 0.5):
+                decision = 'skip'
+        elif unimportant:
+            decision = 'skip'
+    if decision == 'skip':
+        stats['skipped'] += 1
+    else:
+        stats['llm'] += 1
+    return decision
+
+def report():
+    total = stats['llm'] + stats['skipped']
+    if not total:
+        return ""
+    return "pre-filter skipped %d of %d messages" % (stats['skipped'], total)
@@ -0,0 +1,252 @@
+# store.py
+#
+# Local store of Aila: the ids of the posts and messages that have already been
+# handled and the state kept between runs. The store is a SQLite database so
+# lookups are indexed, every change is written in its own transaction and a
+# crash in the middle of a run never corrupts or loses what was saved before.
+
+import sqlite3
+import threading
+import hashlib
+import json
+import os
+import re
+import time
+
+# Items older than this are evicted from the store. It must be longer than the
+# cutoff used when fetching from Aula so evicted items are never seen again.
+retention_days = 30
+
+# Maximum number of LLM results kept in the cache, the least recently used go first
+cache_size = 5000
+
+# Maximum number of LLM verdicts kept for training the pre-filter, the oldest go first
+verdict_size = 2000
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def cache_key(*parts):
+    # Key of a cached LLM result from everything the result depends on
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+class Store:
+    def __init__(self, filename='aila.db', retention_days=retention_days, cache_size=cache_size):
+        self.filename = filename
+        self.retention_days = retention_days
+        self.cache_size = cache_size
+        # The store is shared between the GUI and the worker, a lock serializes access
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        # Write ahead logging keeps the database consistent if the program is killed mid-write
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            # kind is the source of the item ('post' or 'message'), time the
+            # timestamp of the item and seen when it was handled (both unix time)
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS seen (
+                kind TEXT NOT NULL, id TEXT NOT NULL, time REAL, hash TEXT, seen REAL NOT NULL,
+                PRIMARY KEY (kind, id)) WITHOUT ROWID''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS seen_time ON seen (time)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            # LLM results by cache_key(), used is when the result was last read or written
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+            # importance verdicts of the LLM by message text, used to train the pre-filter
+            self.conn.execute('CREATE TABLE IF NOT EXISTS verdicts (hash TEXT PRIMARY KEY, text TEXT NOT NULL, important INTEGER NOT NULL, time REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS verdicts_time ON verdicts (time)')
+            # per message thread the id and time of the last message read and
+            # the rolling summary of the thread up to that message
+            self.conn.execute('CREATE TABLE IF NOT EXISTS threads (id TEXT PRIMARY KEY, last_id TEXT NOT NULL, time REAL NOT NULL, summary TEXT)')
+            # embeddings of the texts read by the LLM and their results, used to
+            # recognize copies of a text arriving later. details holds the
+            # numbers and dates of the text, a copy must have the same.
+            self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL, result TEXT NOT NULL, time REAL NOT NULL, details TEXT)')
+            if 'details' not in [column[1] for column in self.conn.execute('PRAGMA table_info(embeddings)')]:
+                self.conn.execute('ALTER TABLE embeddings ADD COLUMN details TEXT')
+            # archive of all posts and messages read with the results of the LLM,
+            # kept for good so old messages can be searched
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS archive (
+                rowid INTEGER PRIMARY KEY, kind TEXT NOT NULL, id TEXT NOT NULL, time REAL NOT NULL,
+                title TEXT, sender TEXT, text TEXT, summary TEXT, important INTEGER, category TEXT, deadline TEXT, vector BLOB,
+                UNIQUE (kind, id))''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS archive_time ON archive (time)')
+        # full-text index of the archive, kept up to date by triggers. Without
+        # FTS5 in the SQLite library the archive is searched by scanning it.
+        try:
+            with self.conn:
+                self.conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(
+                    title, sender, text, summary, content='archive', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')''')
+                self.conn.execute('''CREATE TRIGGER IF NOT EXISTS archive_insert AFTER INSERT ON archive BEGIN
+                    INSERT INTO archive_fts (rowid, title, sender, text, summary) VALUES (new.rowid, new.title, new.sender, new.text, new.summary);
+                    END''')
+                self.conn.execute('''CREATE TRIGGER IF NOT EXISTS archive_delete AFTER DELETE ON archive BEGIN
+                    INSERT INTO archive_fts (archive_fts, rowid, title, sender, text, summary) VALUES ('delete', old.rowid, old.title, old.sender, old.text, old.summary);
+                    END''')
+                self.conn.execute('''CREATE TRIGGER IF NOT EXISTS archive_update AFTER UPDATE ON archive BEGIN
+                    INSERT INTO archive_fts (archive_fts, rowid, title, sender, text, summary) VALUES ('delete', old.rowid, old.title, old.sender, old.text, old.summary);
+                    INSERT INTO archive_fts (rowid, title, sender, text, summary) VALUES (new.rowid, new.title, new.sender, new.text, new.summary);
+                    END''')
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    def seen(self, kind, id):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM seen WHERE kind = ? AND id = ?', (kind, str(id))).fetchone()
+        return row is not None
+
+    def mark(self, kind, id, timestamp=None, text=None):
+        # Record an item as handled. timestamp is a datetime, text the content
+        # the item had when it was handled.
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO seen (kind, id, time, hash, seen) VALUES (?, ?, ?, ?, ?)',
+                              (kind, str(id), timestamp.timestamp() if timestamp else now,
+                               content_hash(text) if text is not None else None, now))
+
+    def thread(self, id):
+        # (id of the last message read, rolling summary) of a thread, or None if never read
+        with self.lock:
+            row = self.conn.execute('SELECT last_id, summary FROM threads WHERE id = ?', (str(id),)).fetchone()
+        return row
+
+    def set_thread(self, id, last_id, timestamp=None, summary=None):
+        # Record the last message read in a thread and the summary of the thread up to it
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO threads (id, last_id, time, summary) VALUES (?, ?, ?, ?)',
+                              (str(id), str(last_id), timestamp.timestamp() if timestamp else time.time(), summary))
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def cache_get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE cache SET used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def cache_put(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cache (key, value, used) VALUES (?, ?, ?)',
+                              (key, json.dumps(value), time.time()))
+            # Drop the least recently used results beyond the cache size
+            self.conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                              (self.cache_size,))
+
+    def add_verdict(self, text, important):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO verdicts (hash, text, important, time) VALUES (?, ?, ?, ?)',
+                              (content_hash(text), text, int(bool(important)), time.time()))
+            self.conn.execute('DELETE FROM verdicts WHERE hash IN (SELECT hash FROM verdicts ORDER BY time DESC LIMIT -1 OFFSET ?)',
+                              (verdict_size,))
+
+    def verdicts(self):
+        # all kept verdicts as (text, important)
+        with self.lock:
+            return [(text, bool(important)) for text, important in self.conn.execute('SELECT text, important FROM verdicts')]
+
+    def add_embedding(self, text, vector, details, result):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO embeddings (hash, vector, result, time, details) VALUES (?, ?, ?, ?, ?)',
+                              (content_hash(text), vector, json.dumps(result), time.time(), details))
+
+    def embeddings(self):
+        # all kept embeddings as (vector, details, result)
+        with self.lock:
+            return [(vector, details, json.loads(result)) for vector, details, result in
+                    self.conn.execute('SELECT vector, details, result FROM embeddings')]
+
+    def archive(self, kind, id, timestamp, title, sender, text, result, vector=None):
+        # Keep a post or message with the result of the LLM for searching
+        with self.lock, self.conn:
+            self.conn.execute('''INSERT INTO archive (kind, id, time, title, sender, text, summary, important, category, deadline, vector)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (kind, id) DO UPDATE SET
+                time = excluded.time, title = excluded.title, sender = excluded.sender, text = excluded.text, summary = excluded.summary,
+                important = excluded.important, category = excluded.category, deadline = excluded.deadline,
+                vector = coalesce(excluded.vector, vector)''',
+                (kind, str(id), timestamp.timestamp() if timestamp else time.time(), title, sender, text, result.get('summary'),
+                 int(bool(result.get('important'))), result.get('category'), result.get('deadline'), vector))
+
+    def search(self, query, limit=20):
+        # Archived items containing all words of the query (or words starting
+        # with them), best match first
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return []
+        with self.lock:
+            if self.fts:
+                rows = self.conn.execute('''SELECT archive.* FROM archive_fts JOIN archive ON archive.rowid = archive_fts.rowid
+                    WHERE archive_fts MATCH ? ORDER BY archive_fts.rank LIMIT ?''',
+                    (" ".join('"%s"*' % word for word in words), limit))
+            else:
+                rows = self.conn.execute('SELECT * FROM archive WHERE ' +
+                    ' AND '.join(["lower(coalesce(title, '') || ' ' || coalesce(sender, '') || ' ' || coalesce(text, '') || ' ' || coalesce(summary, '')) LIKE ?"] * len(words)) +
+                    ' ORDER BY time DESC LIMIT ?', ['%' + word + '%' for word in words] + [limit])
+            return [self.hit(row) for row in rows]
+
+    def recent(self, before=None, limit=20):
+        # archived items from the time before (unix time) and earlier, newest first
+        with self.lock:
+            if before is None:
+                rows = self.conn.execute('SELECT * FROM archive ORDER BY time DESC LIMIT ?', (limit,))
+            else:
+                rows = self.conn.execute('SELECT * FROM archive WHERE time <= ? ORDER BY time DESC LIMIT ?', (before, limit))
+            return [self.hit(row) for row in rows]
+
+    def archive_vectors(self):
+        # (rowid, vector) of the archived items with an embedding
+        with self.lock:
+            return self.conn.execute('SELECT rowid, vector FROM archive WHERE vector IS NOT NULL').fetchall()
+
+    def archived(self, rowids):
+        # archived items by rowid, in the given order
+        with self.lock:
+            rows = {row[0]: self.hit(row) for row in self.conn.execute(
+                'SELECT * FROM archive WHERE rowid IN (%s)' % ','.join('?' * len(rowids)), list(rowids))}
+        return [rows[rowid] for rowid in rowids if rowid in rows]
+
+    def hit(self, row):
+        # dict of an archive row without the embedding
+        rowid, kind, id, timestamp, title, sender, text, summary, important, category, deadline, vector = row
+        return {'kind': kind, 'id': id, 'time': timestamp, 'title': title, 'sender': sender, 'text': text, 'response': summary,
+                'important': bool(important), 'category': category, 'deadline': deadline}
+
+    def evict(self):
+        # Drop items older than the retention window
+        limit = time.time() - self.retention_days * 24 * 3600
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM threads WHERE time < ?', (limit,))
+            self.conn.execute('DELETE FROM embeddings WHERE time < ?', (limit,))
+            return self.conn.execute('DELETE FROM seen WHERE time < ?', (limit,)).rowcount
+
+    def import_json(self, filename='aila.json'):
+        # Import the id lists of the JSON file used by earlier versions of Aila.
+        # The ids get the current time so they live for one retention window.
+        if self.get('imported_json') or not os.path.exists(filename):
+            return
+        try:
+            with open(filename, 'r') as file:
+                old = json.load(file)
+        except ValueError:
+            old = {}
+        now = time.time()
+        with self.lock, self.conn:
+            for kind, key in (('message', 'message_ids'), ('post', 'post_ids')):
+                self.conn.executemany('INSERT OR IGNORE INTO seen (kind, id, time, seen) VALUES (?, ?, ?, ?)',
+                                      [(kind, str(id), now, now) for id in old.get(key, [])])
+            if old.get('sync'):
+                self.conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('sync', json.dumps(old['sync'])))
+            self.conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('imported_json', 'true'))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()